@@ -0,0 +1,118 @@
+"""
+Telegram file_id registry for Photo Bot's local images (logo, category and example images).
+The first upload of an image stores the file_id Telegram returns, keyed by
+path and content hash and persisted in SQLite; later sends reuse the file_id,
+so browsing uploads nothing. Replacing an image changes its hash, and the new
+content is uploaded once more.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+from typing import Awaitable, Callable
+
+from telegram.error import BadRequest, RetryAfter
+
+import database as db
+
+logger = logging.getLogger(__name__)
+
+WARMUP_INTERVAL = 1.0  # seconds between warm-up uploads (Telegram allows ~1 message/s per chat)
+
+_base_dir = os.curdir
+_file_ids: dict[tuple[str, str], str] = {}  # (relative path, sha256) → Telegram file_id
+_digests: dict[str, tuple[tuple[int, int], str]] = {}  # path → ((mtime_ns, size), sha256)
+
+
+def init(base_dir: str) -> None:
+    """Load the stored file_ids; paths are keyed relative to base_dir so they survive redeploys."""
+    global _base_dir
+    _base_dir = base_dir
+    _file_ids.clear()
+    _file_ids.update(db.get_asset_file_ids())
+    logger.info(f"Asset registry loaded ({len(_file_ids)} file_ids)")
+
+
+def _key(path: str) -> tuple[str, str]:
+    """(relative path, content hash) of a file; the hash is recomputed only when the file changes."""
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _digests.get(path)
+    if cached is None or cached[0] != version:
+        with open(path, "rb") as f:
+            cached = (version, hashlib.sha256(f.read()).hexdigest())
+        _digests[path] = cached
+    return os.path.relpath(path, _base_dir), cached[1]
+
+
+def content_hash(path: str) -> str:
+    """SHA-256 of a file's content (cached until the file changes)."""
+    return _key(path)[1]
+
+
+def file_id(path: str) -> str | None:
+    """Stored file_id for the current content of path, if it was uploaded before."""
+    return _file_ids.get(_key(path))
+
+
+async def send(path: str, call: Callable[[object], Awaitable[object]]):
+    """Send a local image through call(media), reusing its file_id when there is one.
+
+    call gets either a file_id or an open file and returns the resulting
+    Message, e.g. a lambda around send_photo or edit_message_media. The
+    file_id of the first upload is remembered; a stored file_id that
+    Telegram rejects is dropped and the file uploaded again.
+    """
+    key = _key(path)
+    cached = _file_ids.get(key)
+    if cached:
+        try:
+            return await call(cached)
+        except BadRequest as e:
+            if "file" not in str(e).lower():
+                raise  # e.g. "message is not modified": not about the file_id
+            logger.warning(f"Stored file_id for {key[0]} rejected ({e}), uploading again")
+            _file_ids.pop(key, None)
+            db.delete_asset_file_id(*key)
+
+    with open(path, "rb") as f:
+        message = await call(f)
+    photo = getattr(message, "photo", None)
+    if photo:
+        _file_ids[key] = photo[-1].file_id
+        db.save_asset_file_id(key[0], key[1], photo[-1].file_id)
+    return message
+
+
+async def warm_up(bot, chat_id: int, paths: list[str]) -> int:
+    """Upload every image in paths that has no file_id yet to chat_id, deleting each message again.
+
+    Returns the number uploaded. Meant to run in the background at startup.
+    """
+    uploaded = 0
+    for path in dict.fromkeys(paths):
+        if not path or not os.path.exists(path) or file_id(path):
+            continue
+        message = None
+        for _ in range(2):  # one more try after a flood-control wait
+            try:
+                message = await send(
+                    path, lambda media: bot.send_photo(chat_id=chat_id, photo=media, disable_notification=True)
+                )
+                break
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logger.warning(f"Asset warm-up failed for {path}: {e}")
+                break
+        if message is None:
+            continue
+        uploaded += 1
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+        except Exception:
+            pass
+        await asyncio.sleep(WARMUP_INTERVAL)
+    logger.info(f"Asset warm-up done: {uploaded} uploaded, {len(_file_ids)} file_ids stored")
+    return uploaded
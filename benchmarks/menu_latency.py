@@ -0,0 +1,142 @@
+"""
+Benchmark menu-callback latency while image generations are in flight.
+
+Simulates a sequential update loop (PTB's default) feeding N photo
+updates followed by a steady stream of menu callbacks. Gemini is
+replaced by a fake client that sleeps for --gen-seconds, so no API key
+or network is needed.
+
+Modes:
+    sync      — original path: blocking client.models.generate_content in the handler
+    async     — generation.generate_content awaited inside the handler
+    nonblock  — the handler hands generation off to a background task and returns
+
+The bot itself now works like nonblock: handle_photo only queues a job for
+the scheduler.py worker pool and returns, and updates go through
+monitoring.InstrumentedUpdateProcessor (different users in parallel, each
+user's in order). The sequential loop here is the worst case, one user's
+updates back to back.
+
+Usage:
+    python benchmarks/menu_latency.py
+    python benchmarks/menu_latency.py --generations 20 --gen-seconds 5 --callbacks 200
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+# Add parent directory to path so we can import bot modules
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import generation as gen
+
+
+class _FakeModels:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+    def generate_content(self, **kwargs):
+        time.sleep(self.seconds)
+        return object()
+
+
+class _FakeAsyncModels(_FakeModels):
+    async def generate_content(self, **kwargs):
+        await asyncio.sleep(self.seconds)
+        return object()
+
+
+class FakeClient:
+    """Stand-in for genai.Client with a fixed generation time."""
+
+    def __init__(self, seconds: float):
+        self.models = _FakeModels(seconds)
+        self.aio = type("aio", (), {"models": _FakeAsyncModels(seconds)})()
+
+
+async def run_mode(mode: str, client: FakeClient, generations: int, callbacks: int, interval: float) -> list[float]:
+    """Feed updates through a sequential update loop, return menu latencies in ms."""
+    queue: asyncio.Queue = asyncio.Queue()
+    latencies: list[float] = []
+    background: set[asyncio.Task] = set()
+
+    async def photo_handler():
+        if mode == "sync":
+            client.models.generate_content(model="fake", contents=[], config=None)
+        else:
+            await gen.generate_content("fake", "prompt", None)
+
+    async def menu_handler(enqueued_at: float):
+        await asyncio.sleep(0)  # answer callback / edit message
+        latencies.append((time.perf_counter() - enqueued_at) * 1000)
+
+    async def update_loop():
+        while True:
+            kind, enqueued_at = await queue.get()
+            if kind is None:
+                break
+            if kind == "photo":
+                if mode == "nonblock":
+                    task = asyncio.create_task(photo_handler())
+                    background.add(task)
+                    task.add_done_callback(background.discard)
+                else:
+                    await photo_handler()
+            else:
+                await menu_handler(enqueued_at)
+
+    loop_task = asyncio.create_task(update_loop())
+
+    for _ in range(generations):
+        queue.put_nowait(("photo", time.perf_counter()))
+    # Latency is measured from the scheduled send time, so a blocked loop
+    # that delays the feeder itself still shows up in the numbers.
+    start = time.perf_counter()
+    for i in range(callbacks):
+        queue.put_nowait(("menu", start + i * interval))
+        await asyncio.sleep(max(0.0, start + (i + 1) * interval - time.perf_counter()))
+    queue.put_nowait((None, 0.0))
+
+    await loop_task
+    if background:
+        await asyncio.gather(*background)
+    return latencies
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Menu latency under in-flight generations.")
+    parser.add_argument("--generations", type=int, default=20, help="Generations in flight")
+    parser.add_argument("--gen-seconds", type=float, default=2.0, help="Fake Gemini latency per call")
+    parser.add_argument("--callbacks", type=int, default=100, help="Menu callbacks to send")
+    parser.add_argument("--interval", type=float, default=0.02, help="Seconds between callbacks")
+    parser.add_argument("--concurrency", type=int, default=gen.DEFAULT_MAX_CONCURRENCY, help="Gemini concurrency cap")
+    parser.add_argument("--modes", default="sync,async,nonblock", help="Comma-separated modes to run")
+    args = parser.parse_args()
+
+    client = FakeClient(args.gen_seconds)
+
+    print(f"{args.generations} generations × {args.gen_seconds}s, {args.callbacks} menu callbacks, "
+          f"concurrency cap {args.concurrency}")
+    print()
+    print(f"  {'mode':<10} {'p50 ms':>10} {'p99 ms':>10} {'max ms':>10}")
+
+    for mode in args.modes.split(","):
+        gen.init_generation(client, args.concurrency, key_rpm=1e6, stream=False)  # fake client: no quota, no streaming
+        latencies = asyncio.run(run_mode(mode, client, args.generations, args.callbacks, args.interval))
+        print(f"  {mode:<10} {statistics.median(latencies):>10.1f} "
+              f"{percentile(latencies, 99):>10.1f} {max(latencies):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Micro-benchmark of input photo preprocessing (decode + resize) per photo.
+
+Compares the old path (full decode + thumbnail, as drop_pipeline used to do)
+with images.preprocess_input (JPEG draft decode, EXIF fix, passthrough).
+Uses photos from --photos if given, otherwise synthetic phone-sized JPEGs.
+
+Usage:
+    python benchmarks/preprocess.py
+    python benchmarks/preprocess.py --photos "testing/Avatar Drop/photos" --repeat 5
+"""
+
+import argparse
+import io
+import statistics
+import sys
+import time
+from pathlib import Path
+
+# Add parent directory to path so we can import bot modules
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from PIL import Image, ImageDraw
+
+import images
+
+SYNTHETIC_SIZES = [(4032, 3024), (3000, 4000), (1920, 1080), (1280, 960), (800, 600)]
+
+
+def synthetic_photo(size: tuple[int, int]) -> bytes:
+    """Phone-like JPEG with enough detail that compression isn't trivial."""
+    image = Image.effect_noise(size, 40).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for i in range(0, size[0], 97):
+        draw.line([(i, 0), (size[0] - i, size[1])], fill=(i % 255, 80, 160), width=9)
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=92)
+    return buf.getvalue()
+
+
+def load_photos(folder: str | None) -> list[tuple[str, bytes]]:
+    if not folder:
+        return [(f"synthetic {w}x{h}", synthetic_photo((w, h))) for w, h in SYNTHETIC_SIZES]
+    paths = sorted(
+        p for p in Path(folder).iterdir()
+        if p.suffix.lower() in {".jpg", ".jpeg", ".png", ".webp"}
+    )
+    return [(p.name, p.read_bytes()) for p in paths]
+
+
+def old_path(data: bytes, max_side: int) -> bytes:
+    """Previous behaviour: full-resolution decode, thumbnail, PNG for the SDK."""
+    image = Image.open(io.BytesIO(data))
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    buf = io.BytesIO()
+    image.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def timed(fn, data: bytes, max_side: int, repeat: int) -> tuple[float, int]:
+    """Median milliseconds per call and output size in bytes."""
+    times = []
+    out = b""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn(data, max_side)
+        times.append((time.perf_counter() - start) * 1000)
+    if isinstance(out, tuple):
+        out = out[0]
+    return statistics.median(times), len(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode + resize time per photo.")
+    parser.add_argument("--photos", help="Folder with test photos (default: synthetic)")
+    parser.add_argument("--max-side", type=int, default=images.DEFAULT_MAX_INPUT_SIDE)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    photos = load_photos(args.photos)
+    print(f"max side {args.max_side}px, median of {args.repeat} runs\n")
+    print(f"  {'photo':<24} {'in KB':>8} {'old ms':>8} {'old KB':>8} {'new ms':>8} {'new KB':>8}")
+
+    for name, data in photos:
+        old_ms, old_size = timed(old_path, data, args.max_side, args.repeat)
+        new_ms, new_size = timed(images.preprocess_input, data, args.max_side, args.repeat)
+        print(f"  {name[:24]:<24} {len(data) / 1024:>8.0f} {old_ms:>8.1f} {old_size / 1024:>8.0f} "
+              f"{new_ms:>8.1f} {new_size / 1024:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,10 +7,13 @@ import os
 import sqlite3
 import secrets
 import string
+import time
 from datetime import datetime, timezone
 from pathlib import Path
 from typing import Optional
 
+import metrics
+
 # Database file path
 # On Railway: uses /data/photo_bot.db (set via DB_PATH env var)
 # Locally: uses photo_bot.db in same directory as this script
@@ -18,9 +21,37 @@ default_db_path = str(Path(__file__).parent / "photo_bot.db")
 DB_PATH = Path(os.getenv("DB_PATH", default_db_path))
 
 
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records statement execution time in metrics."""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.observe("photobot_db_query_seconds", time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.observe("photobot_db_query_seconds", time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors (including conn.execute) are TimedCursors."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+
 def get_connection() -> sqlite3.Connection:
     """Get a database connection with row factory enabled."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, factory=TimedConnection)
     conn.row_factory = sqlite3.Row
     return conn
 
@@ -101,6 +132,26 @@ def init_db() -> None:
         cursor.execute("ALTER TABLE generations ADD COLUMN status TEXT NOT NULL DEFAULT 'success'")
     except Exception:
         pass  # Column already exists
+    # Migration: add model (which Gemini model served the generation)
+    try:
+        cursor.execute("ALTER TABLE generations ADD COLUMN model TEXT")
+    except Exception:
+        pass  # Column already exists
+    # Migration: add telemetry columns (NULL for rows recorded before them)
+    for column in (
+        "duration_ms INTEGER",
+        "gemini_ms INTEGER",
+        "input_bytes INTEGER",
+        "output_bytes INTEGER",
+        "prompt_tokens INTEGER",
+        "output_tokens INTEGER",
+        "total_tokens INTEGER",
+        "failure_class TEXT",
+    ):
+        try:
+            cursor.execute(f"ALTER TABLE generations ADD COLUMN {column}")
+        except Exception:
+            pass  # Column already exists
 
     # Purchases table (tracks package purchases for revenue stats)
     cursor.execute("""
@@ -148,6 +199,70 @@ def init_db() -> None:
     for _name in ("vk", "instagram", "tiktok"):
         cursor.execute("INSERT OR IGNORE INTO source_links (name) VALUES (?)", (_name,))
 
+    # Generation jobs table (durable queue: survives restarts between deduct and delivery)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS generation_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            effect_id TEXT NOT NULL,
+            prompt TEXT NOT NULL,
+            photo_file_id TEXT NOT NULL,
+            previous_category TEXT,
+            status_message_id INTEGER,
+            anchor_message_id INTEGER,
+            state TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            not_before TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_jobs_state
+        ON generation_jobs(state)
+    """)
+    # Migration: add variants (images generated from one upload, one credit each)
+    try:
+        cursor.execute("ALTER TABLE generation_jobs ADD COLUMN variants INTEGER NOT NULL DEFAULT 1")
+    except Exception:
+        pass  # Column already exists
+    # Migration: add hold_id (credit hold the job commits on delivery or releases on failure)
+    try:
+        cursor.execute("ALTER TABLE generation_jobs ADD COLUMN hold_id INTEGER")
+    except Exception:
+        pass  # Column already exists
+
+    # Credit holds (reserved at request time; committed on delivery, released on failure)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS credit_holds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            charged INTEGER,
+            state TEXT NOT NULL DEFAULT 'reserved',
+            expires_at TIMESTAMP NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_holds_user_state
+        ON credit_holds(user_id, state)
+    """)
+
+    # Telegram file_ids of uploaded local images (logo, category and example images)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS asset_files (
+            path TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (path, content_hash)
+        )
+    """)
+
     # Create indexes for notification_log
     cursor.execute("""
         CREATE INDEX IF NOT EXISTS idx_notif_user
@@ -225,7 +340,7 @@ def get_or_create_user(
 
 
 def add_credits(telegram_id: int, amount: int) -> int:
-    """Add credits to user. Returns new balance."""
+    """Add credits to user. Returns new available balance."""
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
@@ -233,54 +348,163 @@ def add_credits(telegram_id: int, amount: int) -> int:
         (amount, telegram_id),
     )
     conn.commit()
-    cursor.execute("SELECT credits FROM users WHERE telegram_id = ?", (telegram_id,))
+    balance = _balance(cursor, telegram_id)
+    conn.close()
+    return balance
+
+
+def _balance(cursor: sqlite3.Cursor, telegram_id: int) -> int:
+    cursor.execute(
+        """
+        SELECT u.credits - COALESCE(
+            (SELECT SUM(amount) FROM credit_holds WHERE user_id = u.telegram_id AND state = 'reserved'), 0
+        ) AS balance
+        FROM users u
+        WHERE u.telegram_id = ?
+        """,
+        (telegram_id,),
+    )
     result = cursor.fetchone()
+    return result["balance"] if result else 0
+
+
+def get_balance(telegram_id: int) -> int:
+    """Credits the user can spend now: balance minus credits held by pending generations."""
+    conn = get_connection()
+    balance = _balance(conn.cursor(), telegram_id)
     conn.close()
-    return result["credits"] if result else 0
+    return balance
+
+
+# ── Credit Holds ─────────────────────────────────────────────────────────────
 
+# How long a hold that no live job claims is kept before the sweeper releases it
+HOLD_TTL_SECONDS = 600
 
-def deduct_credit(telegram_id: int) -> bool:
+
+def reserve_credits(telegram_id: int, amount: int = 1, ttl_seconds: int = HOLD_TTL_SECONDS) -> Optional[int]:
     """
-    Deduct 1 credit from user.
-    Returns True if successful, False if insufficient credits.
+    Hold credits for a generation if the available balance covers them.
+    Single atomic statement; the users table is not written.
+    Returns the hold id, or None if insufficient credits.
     """
-    user = get_user(telegram_id)
-    if not user or user["credits"] < 1:
-        return False
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        INSERT INTO credit_holds (user_id, amount, expires_at)
+        SELECT u.telegram_id, ?, datetime('now', ?)
+        FROM users u
+        WHERE u.telegram_id = ?
+          AND u.credits - COALESCE(
+              (SELECT SUM(amount) FROM credit_holds WHERE user_id = u.telegram_id AND state = 'reserved'), 0
+          ) >= ?
+        """,
+        (amount, f"{int(ttl_seconds):+d} seconds", telegram_id, amount),
+    )
+    hold_id = cursor.lastrowid if cursor.rowcount else None
+    conn.commit()
+    conn.close()
+    return hold_id
+
 
+def commit_hold(hold_id: int, charged: int, job_id: Optional[int] = None) -> bool:
+    """
+    Charge `charged` of a held amount (the rest is released) and, if job_id is
+    given, close that job as 'done' in the same transaction.
+    Returns False if the hold was no longer reserved (nothing is charged then).
+    """
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
         """
-        UPDATE users
-        SET credits = credits - 1, total_spent = total_spent + 1
-        WHERE telegram_id = ? AND credits > 0
+        UPDATE credit_holds
+        SET state = 'committed', charged = MIN(?, amount), updated_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND state = 'reserved'
         """,
-        (telegram_id,),
+        (charged, hold_id),
     )
-    success = cursor.rowcount > 0
+    committed = cursor.rowcount > 0
+    if committed:
+        cursor.execute(
+            """
+            UPDATE users
+            SET credits = credits - (SELECT charged FROM credit_holds WHERE id = ?),
+                total_spent = total_spent + (SELECT charged FROM credit_holds WHERE id = ?)
+            WHERE telegram_id = (SELECT user_id FROM credit_holds WHERE id = ?)
+            """,
+            (hold_id, hold_id, hold_id),
+        )
+    if job_id is not None:
+        _finish_job(cursor, job_id, "done")
     conn.commit()
     conn.close()
-    return success
+    return committed
 
 
-def refund_credit(telegram_id: int) -> int:
-    """Refund 1 credit (after Gemini failure). Returns new balance."""
+def release_hold(
+    hold_id: int, job_id: Optional[int] = None, error: Optional[str] = None, state: str = "failed"
+) -> None:
+    """Release a hold without charging and, if job_id is given, close that job as `state` ('failed' or 'cancelled')."""
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
         """
-        UPDATE users
-        SET credits = credits + 1, total_spent = total_spent - 1
-        WHERE telegram_id = ?
+        UPDATE credit_holds
+        SET state = 'released', charged = 0, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND state = 'reserved'
         """,
-        (telegram_id,),
+        (hold_id,),
     )
+    if job_id is not None:
+        _finish_job(cursor, job_id, state, error)
     conn.commit()
-    cursor.execute("SELECT credits FROM users WHERE telegram_id = ?", (telegram_id,))
-    result = cursor.fetchone()
     conn.close()
-    return result["credits"] if result else 0
+
+
+def sweep_holds() -> tuple[int, int]:
+    """
+    Reconcile holds with jobs. Returns (jobs adopted, holds released).
+
+    - Live (queued/running) jobs paid by the old upfront deduction get that
+      deduction turned back into a hold, so they settle like any other job.
+    - Expired holds that no live job claims (crash between reserve and job
+      creation, or a job that ended without settling) are released.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.execute(
+        "SELECT id, user_id, variants FROM generation_jobs WHERE state IN ('queued', 'running') AND hold_id IS NULL"
+    )
+    unheld = cursor.fetchall()
+    for job in unheld:
+        cursor.execute(
+            "UPDATE users SET credits = credits + ?, total_spent = total_spent - ? WHERE telegram_id = ?",
+            (job["variants"], job["variants"], job["user_id"]),
+        )
+        cursor.execute(
+            "INSERT INTO credit_holds (user_id, amount, expires_at) VALUES (?, ?, datetime('now', ?))",
+            (job["user_id"], job["variants"], f"+{HOLD_TTL_SECONDS} seconds"),
+        )
+        cursor.execute("UPDATE generation_jobs SET hold_id = ? WHERE id = ?", (cursor.lastrowid, job["id"]))
+
+    cursor.execute(
+        """
+        UPDATE credit_holds
+        SET state = 'released', charged = 0, updated_at = CURRENT_TIMESTAMP
+        WHERE state = 'reserved'
+          AND expires_at < CURRENT_TIMESTAMP
+          AND NOT EXISTS (
+              SELECT 1 FROM generation_jobs j
+              WHERE j.hold_id = credit_holds.id AND j.state IN ('queued', 'running')
+          )
+        """
+    )
+    released = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return len(unheld), released
 
 
 def _count_credited_referrals(cursor: sqlite3.Cursor, referrer_id: int) -> int:
@@ -446,18 +670,178 @@ def redeem_promo_code(telegram_id: int, code: str) -> tuple[bool, str, int]:
 # ── Generation Tracking ──────────────────────────────────────────────────────
 
 
-def record_generation(telegram_id: int, effect_id: str, status: str = "success") -> None:
-    """Record a generation attempt for statistics."""
+def record_generation(
+    telegram_id: int,
+    effect_id: str,
+    status: str = "success",
+    model: Optional[str] = None,
+    duration_ms: Optional[int] = None,
+    gemini_ms: Optional[int] = None,
+    input_bytes: Optional[int] = None,
+    output_bytes: Optional[int] = None,
+    prompt_tokens: Optional[int] = None,
+    output_tokens: Optional[int] = None,
+    total_tokens: Optional[int] = None,
+    failure_class: Optional[str] = None,
+) -> None:
+    """Record a generation attempt for statistics, with whatever telemetry is known."""
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
-        "INSERT INTO generations (user_id, effect_id, status) VALUES (?, ?, ?)",
-        (telegram_id, effect_id, status),
+        """INSERT INTO generations (
+               user_id, effect_id, status, model, duration_ms, gemini_ms, input_bytes, output_bytes,
+               prompt_tokens, output_tokens, total_tokens, failure_class
+           ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (
+            telegram_id, effect_id, status, model, duration_ms, gemini_ms, input_bytes, output_bytes,
+            prompt_tokens, output_tokens, total_tokens, failure_class,
+        ),
     )
     conn.commit()
     conn.close()
 
 
+# ── Generation Jobs ──────────────────────────────────────────────────────────
+# Job states: queued → running → done | failed | cancelled (running → queued on retry/restart;
+# queued → cancelled when the user cancels before it starts)
+
+
+def get_recent_generations(hours: int = 24) -> list[sqlite3.Row]:
+    """effect_id, status and failure_class of generations in the last N hours, oldest first."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT effect_id, status, failure_class
+        FROM generations
+        WHERE created_at >= datetime('now', ?)
+        ORDER BY id
+        """,
+        (f"-{hours} hours",),
+    )
+    rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+
+def create_job(
+    telegram_id: int,
+    chat_id: int,
+    effect_id: str,
+    prompt: str,
+    photo_file_id: str,
+    previous_category: Optional[str] = None,
+    status_message_id: Optional[int] = None,
+    anchor_message_id: Optional[int] = None,
+    variants: int = 1,
+    hold_id: Optional[int] = None,
+) -> sqlite3.Row:
+    """Persist a new queued generation job. Returns the job row."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        INSERT INTO generation_jobs (
+            user_id, chat_id, effect_id, prompt, photo_file_id,
+            previous_category, status_message_id, anchor_message_id, variants, hold_id
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (telegram_id, chat_id, effect_id, prompt, photo_file_id,
+         previous_category, status_message_id, anchor_message_id, variants, hold_id),
+    )
+    job_id = cursor.lastrowid
+    conn.commit()
+    cursor.execute("SELECT * FROM generation_jobs WHERE id = ?", (job_id,))
+    job = cursor.fetchone()
+    conn.close()
+    return job
+
+
+def requeue_interrupted_jobs() -> int:
+    """Move jobs left 'running' by a crashed/restarted process back to 'queued'. Returns count."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE generation_jobs SET state = 'queued', updated_at = CURRENT_TIMESTAMP WHERE state = 'running'"
+    )
+    count = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return count
+
+
+def get_queued_jobs() -> list[sqlite3.Row]:
+    """Queued jobs in submission order, with seconds left until each may run."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT *,
+               MAX(0, COALESCE(strftime('%s', not_before) - strftime('%s', 'now'), 0)) AS delay_seconds
+        FROM generation_jobs
+        WHERE state = 'queued'
+        ORDER BY id
+        """
+    )
+    jobs = cursor.fetchall()
+    conn.close()
+    return jobs
+
+
+def mark_job_running(job_id: int) -> None:
+    """Mark job as picked up by a worker and count the attempt."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        UPDATE generation_jobs
+        SET state = 'running', attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+        """,
+        (job_id,),
+    )
+    conn.commit()
+    conn.close()
+
+
+def retry_job(job_id: int, delay_seconds: int, error: str) -> None:
+    """Put job back in the queue, not to run before delay_seconds from now."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        UPDATE generation_jobs
+        SET state = 'queued', not_before = datetime('now', ?), last_error = ?,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+        """,
+        (f"+{int(delay_seconds)} seconds", error[:500], job_id),
+    )
+    conn.commit()
+    conn.close()
+
+
+def finish_job(job_id: int, state: str, error: Optional[str] = None) -> None:
+    """Close job as 'done', 'failed' or 'cancelled'."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    _finish_job(cursor, job_id, state, error)
+    conn.commit()
+    conn.close()
+
+
+def _finish_job(cursor: sqlite3.Cursor, job_id: int, state: str, error: Optional[str] = None) -> None:
+    cursor.execute(
+        """
+        UPDATE generation_jobs
+        SET state = ?, last_error = COALESCE(?, last_error), updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+        """,
+        (state, error[:500] if error else None, job_id),
+    )
+
+
 # ── Purchase Tracking ────────────────────────────────────────────────────────
 
 
@@ -810,5 +1194,37 @@ def get_source_links() -> list[str]:
     return names
 
 
+# ── Asset Files ──────────────────────────────────────────────────────────────
+
+
+def get_asset_file_ids() -> dict[tuple[str, str], str]:
+    """(path, content_hash) → Telegram file_id for every uploaded asset."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT path, content_hash, file_id FROM asset_files")
+    file_ids = {(row["path"], row["content_hash"]): row["file_id"] for row in cursor.fetchall()}
+    conn.close()
+    return file_ids
+
+
+def save_asset_file_id(path: str, content_hash: str, file_id: str) -> None:
+    """Store (or replace) the file_id Telegram returned for an asset upload."""
+    conn = get_connection()
+    conn.execute(
+        "INSERT OR REPLACE INTO asset_files (path, content_hash, file_id) VALUES (?, ?, ?)",
+        (path, content_hash, file_id),
+    )
+    conn.commit()
+    conn.close()
+
+
+def delete_asset_file_id(path: str, content_hash: str) -> None:
+    """Forget a stored file_id (Telegram rejected it)."""
+    conn = get_connection()
+    conn.execute("DELETE FROM asset_files WHERE path = ? AND content_hash = ?", (path, content_hash))
+    conn.commit()
+    conn.close()
+
+
 # Initialize database on import
 init_db()
@@ -6,28 +6,26 @@ Usage:
     python drop_pipeline.py "testing/Avatar Drop/avatar 10.txt" --split-only
     python drop_pipeline.py "testing/Avatar Drop/avatar 10.txt" --generate-only
     python drop_pipeline.py "testing/Avatar Drop/avatar 10.txt" --force
+    python drop_pipeline.py "testing/Avatar Drop/avatar 10.txt" --profile Custom0218_03_ActionFigureBlister
 """
 
 import argparse
-import io
+import asyncio
 import os
 import re
 import sys
-import time
 
+import yaml
 from dotenv import load_dotenv
-from PIL import Image
 from google import genai
 from google.genai import types
 
+import generation as gen
+import images
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-GEMINI_MODEL = "gemini-3-pro-image-preview"
-SAFETY_SETTINGS = [
-    types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="BLOCK_ONLY_HIGH"),
-    types.SafetySetting(category="HARM_CATEGORY_HATE_SPEECH", threshold="BLOCK_ONLY_HIGH"),
-    types.SafetySetting(category="HARM_CATEGORY_SEXUALLY_EXPLICIT", threshold="BLOCK_ONLY_HIGH"),
-    types.SafetySetting(category="HARM_CATEGORY_DANGEROUS_CONTENT", threshold="BLOCK_ONLY_HIGH"),
-]
+# Generation profile for drops (an effect's profile from --profile is layered on top)
+DROP_PROFILE = {"safety": "BLOCK_ONLY_HIGH"}
 IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
 
 TITLE_RE = re.compile(r"=+\s*IDEA\s+(\d+)\s*:\s*(.+?)\s*=+", re.IGNORECASE)
@@ -157,37 +155,65 @@ def find_prompt_files(folder, folder_label):
     return [os.path.join(folder, f) for f in files]
 
 
-def load_image(photo_path):
-    """Load and resize image (max 1280px), matching test_prompt.py logic."""
-    image = Image.open(photo_path)
-    max_side = 1280
-    if max(image.size) > max_side:
-        image.thumbnail((max_side, max_side), Image.LANCZOS)
-    return image
-
-
-def generate_image(client, prompt, image):
-    """Call Gemini API once. Returns PIL Image or None."""
-    response = client.models.generate_content(
-        model=GEMINI_MODEL,
-        contents=[prompt, image],
-        config=types.GenerateContentConfig(
-            response_modalities=["Text", "Image"],
-            safety_settings=SAFETY_SETTINGS,
-        ),
-    )
+def load_image(photo_path, max_side=images.DEFAULT_MAX_INPUT_SIDE):
+    """Load photo through the same preprocessing stage as the bot. Returns a Gemini Part."""
+    with open(photo_path, "rb") as f:
+        data, mime_type = images.preprocess_input(f.read(), max_side)
+    return types.Part.from_bytes(data=data, mime_type=mime_type)
+
+
+def load_effect_profile(effect_id):
+    """Generation profile of an effects.yaml effect, on top of DROP_PROFILE."""
+    with open(os.path.join(BASE_DIR, "effects.yaml"), "r", encoding="utf-8") as f:
+        effects = yaml.safe_load(f).get("effects", {})
+    if effect_id not in effects:
+        print(f"Error: effect not found in effects.yaml: {effect_id}")
+        sys.exit(1)
+    profile = {**DROP_PROFILE, **gen.effect_profile(effects[effect_id])}
+    gen.validate_profile(profile)
+    return profile
+
 
-    if not response.parts:
-        return None
+async def generate_image(prompt, image, model, profile=DROP_PROFILE):
+    """Call Gemini once through the shared generation layer. Returns (bytes, mime_type) or None."""
+    response = await gen.generate_content(model, prompt, image, config=gen.build_config(profile, model))
 
-    for part in response.parts:
+    for part in response.parts or []:
         if part.inline_data is not None:
-            return Image.open(io.BytesIO(part.inline_data.data))
+            return part.inline_data.data, part.inline_data.mime_type
 
     return None
 
 
-def batch_generate(folder, folder_label, force=False):
+async def _generate_all(tasks, results, models, profile):
+    """Run all generations concurrently; the adaptive limiter decides how many go out at once."""
+    total = len(tasks)
+
+    async def run(i, base_name, photo_name, prompt, image, image_path):
+        try:
+            model = gen.route(models)
+            result = await generate_image(prompt, image, model, profile)
+            if result:
+                data, _ = images.prepare_output(*result, output_format="png")
+                with open(image_path, "wb") as f:
+                    f.write(data)
+                via = f" (fallback: {model})" if model != models[0] else ""
+                print(f"  [{i+1}/{total}] {base_name} + {photo_name} — OK{via}")
+                results[i] = (base_name, photo_name, "success", None)
+            else:
+                # Empty response is deterministic (usually a safety block), not retried
+                error_msg = "No image in response (possible safety block)"
+                print(f"  [{i+1}/{total}] {base_name} + {photo_name} — FAILED: {error_msg}")
+                results[i] = (base_name, photo_name, "failed", error_msg)
+        except Exception as e:
+            error_msg = f"{type(e).__name__}: {e}"
+            print(f"  [{i+1}/{total}] {base_name} + {photo_name} — FAILED: {error_msg}")
+            results[i] = (base_name, photo_name, "failed", error_msg)
+
+    await asyncio.gather(*(run(*task) for task in tasks))
+
+
+def batch_generate(folder, folder_label, force=False, profile=DROP_PROFILE):
     """For each prompt file in folder, generate image with photo cycling."""
     photos = find_photos(folder)
     prompt_files = find_prompt_files(folder, folder_label)
@@ -202,74 +228,50 @@ def batch_generate(folder, folder_label, force=False):
 
     # Load .env and create Gemini client
     load_dotenv(os.path.join(BASE_DIR, ".env"))
-    if "GEMINI_API_KEY" not in os.environ:
-        print("Error: GEMINI_API_KEY not found in .env")
+    api_keys = gen.parse_api_keys(os.environ.get("GEMINI_API_KEYS") or os.environ.get("GEMINI_API_KEY", ""))
+    if not api_keys:
+        print("Error: GEMINI_API_KEY (or GEMINI_API_KEYS) not found in .env")
         sys.exit(1)
 
-    client = genai.Client(api_key=os.environ["GEMINI_API_KEY"])
+    gen.init_generation(
+        [(gen.key_name(key), genai.Client(api_key=key)) for key in api_keys],
+        max_concurrency=int(os.environ.get("GEMINI_MAX_CONCURRENCY", gen.DEFAULT_MAX_CONCURRENCY)),
+        key_rpm=float(os.environ["GEMINI_KEY_RPM"]) if os.environ.get("GEMINI_KEY_RPM") else gen.DEFAULT_KEY_RPM,
+    )
 
-    results = []  # list of (base_name, photo_name, status, error_msg)
+    # Same model route as the bot (GEMINI_MODEL, then GEMINI_FALLBACK_MODELS)
+    models = [os.environ.get("GEMINI_MODEL", gen.DEFAULT_MODEL)] + [
+        m.strip() for m in os.environ.get("GEMINI_FALLBACK_MODELS", ",".join(gen.DEFAULT_FALLBACK_MODELS)).split(",")
+        if m.strip()
+    ]
+
+    results = [None] * len(prompt_files)  # (base_name, photo_name, status, error_msg) per prompt
+    tasks = []
+
+    for i, prompt_path in enumerate(prompt_files):
+        base_name = os.path.splitext(os.path.basename(prompt_path))[0]
+        image_path = os.path.join(folder, f"{base_name}.png")
+        photo_path = photos[i % len(photos)]
+        photo_name = os.path.basename(photo_path)
+
+        # Skip existing
+        if os.path.exists(image_path) and not force:
+            print(f"  [{i+1}/{len(prompt_files)}] {base_name} — exists (skip)")
+            results[i] = (base_name, photo_name, "skipped", None)
+            continue
 
-    try:
-        for i, prompt_path in enumerate(prompt_files):
-            base_name = os.path.splitext(os.path.basename(prompt_path))[0]
-            image_path = os.path.join(folder, f"{base_name}.png")
-            photo_path = photos[i % len(photos)]
-            photo_name = os.path.basename(photo_path)
-
-            # Skip existing
-            if os.path.exists(image_path) and not force:
-                print(f"  [{i+1}/{len(prompt_files)}] {base_name} — exists (skip)")
-                results.append((base_name, photo_name, "skipped", None))
-                continue
-
-            with open(prompt_path, "r", encoding="utf-8") as f:
-                prompt = f.read().strip()
-
-            image = load_image(photo_path)
-
-            print(f"  [{i+1}/{len(prompt_files)}] {base_name} + {photo_name} — generating...", end=" ", flush=True)
-
-            success = False
-            error_msg = None
-
-            for attempt in range(2):  # max 2 attempts (1 retry)
-                try:
-                    result_image = generate_image(client, prompt, image)
-                    if result_image:
-                        result_image.save(image_path, format="PNG")
-                        print("OK")
-                        results.append((base_name, photo_name, "success", None))
-                        success = True
-                        break
-                    else:
-                        error_msg = "No image in response (possible safety block)"
-                        print(f"FAILED: {error_msg}")
-                        results.append((base_name, photo_name, "failed", error_msg))
-                        success = True  # don't retry on empty response (deterministic)
-                        break
-                except KeyboardInterrupt:
-                    raise
-                except Exception as e:
-                    error_msg = f"{type(e).__name__}: {e}"
-                    if attempt == 0:
-                        print(f"error, retrying in 3s...", end=" ", flush=True)
-                        time.sleep(3)
-                    else:
-                        print(f"FAILED: {error_msg}")
-                        results.append((base_name, photo_name, "failed", error_msg))
-
-            if not success and error_msg:
-                pass  # already appended in the loop
-
-            # Pause between API calls
-            if i < len(prompt_files) - 1:
-                time.sleep(2)
+        with open(prompt_path, "r", encoding="utf-8") as f:
+            prompt = f.read().strip()
 
+        tasks.append((i, base_name, photo_name, prompt, load_image(photo_path), image_path))
+
+    print(f"\n  Generating {len(tasks)} images...")
+    try:
+        asyncio.run(_generate_all(tasks, results, models, profile))
     except KeyboardInterrupt:
         print("\n\n  Stopped by user (Ctrl+C)")
 
-    return results
+    return [r for r in results if r is not None]
 
 
 # ── Summary ──────────────────────────────────────────────────────────────────
@@ -316,6 +318,10 @@ def main():
     parser.add_argument("--split-only", action="store_true", help="Only split, skip generation")
     parser.add_argument("--generate-only", action="store_true", help="Only generate from existing prompt files")
     parser.add_argument("--force", action="store_true", help="Overwrite existing files")
+    parser.add_argument(
+        "--profile", metavar="EFFECT_ID",
+        help="Generate with an effects.yaml effect's profile (image_size, aspect_ratio, image_only, safety)",
+    )
     args = parser.parse_args()
 
     ideas_path = os.path.abspath(args.ideas_file)
@@ -341,7 +347,8 @@ def main():
     if not args.split_only:
         print("── Step 2: Generating images ──────────────────────────────")
         photos = find_photos(folder)
-        results = batch_generate(folder, folder_label, force=args.force)
+        profile = load_effect_profile(args.profile) if args.profile else DROP_PROFILE
+        results = batch_generate(folder, folder_label, force=args.force, profile=profile)
         print_summary(folder_name, len(photos), results)
 
 
@@ -0,0 +1,124 @@
+"""
+Per-effect health for Photo Bot.
+Rolling window of recent generation outcomes per effect. An effect whose
+prompt keeps getting blocked or coming back without an image is disabled
+(hidden from the browse menu) for a cooldown; after that it is offered again
+on probation and the first outcome decides whether it is re-enabled.
+Only content failures count: overloads and timeouts say nothing about the prompt.
+"""
+
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FAILURE_RATE = 0.6  # share of content failures in the window that disables an effect
+DEFAULT_MIN_SAMPLES = 8     # outcomes needed before an effect can be disabled
+DEFAULT_COOLDOWN = 1800.0   # seconds an effect stays hidden before a probe
+WINDOW = 20                 # outcomes kept per effect
+
+# Failure classes that point at the effect's prompt rather than at Gemini
+CONTENT_FAILURES = {"blocked", "no_image"}
+
+# Thresholds (set on init)
+_failure_rate = DEFAULT_FAILURE_RATE
+_min_samples = DEFAULT_MIN_SAMPLES
+_cooldown = DEFAULT_COOLDOWN
+
+_outcomes: dict[str, deque[bool]] = {}  # effect_id → recent outcomes (True = image delivered)
+_disabled: dict[str, float] = {}        # effect_id → monotonic time it was disabled
+
+
+def init(
+    failure_rate: float = DEFAULT_FAILURE_RATE,
+    min_samples: int = DEFAULT_MIN_SAMPLES,
+    cooldown: float = DEFAULT_COOLDOWN,
+    history: list | None = None,
+) -> list[str]:
+    """Set thresholds and seed the windows from (effect_id, status, failure_class) rows, oldest first.
+
+    Returns the effects that start disabled.
+    """
+    global _failure_rate, _min_samples, _cooldown
+    _failure_rate = failure_rate
+    _min_samples = max(1, min_samples)
+    _cooldown = cooldown
+    _outcomes.clear()
+    _disabled.clear()
+
+    for effect_id, status, failure_class in history or []:
+        outcome = _outcome(status, failure_class)
+        if outcome is not None:
+            _outcomes.setdefault(effect_id, deque(maxlen=WINDOW)).append(outcome)
+
+    now = time.monotonic()
+    for effect_id in _outcomes:
+        if _is_failing(effect_id):
+            _disabled[effect_id] = now
+    logger.info(
+        f"Effect health initialized (disable at ≥ {failure_rate:.0%} content failures "
+        f"over ≥ {_min_samples} of last {WINDOW}, cooldown {cooldown:.0f}s, {len(_disabled)} disabled)"
+    )
+    return sorted(_disabled)
+
+
+def _outcome(status: str, failure_class: str | None) -> bool | None:
+    """True for a delivered image, False for a content failure, None if it says nothing about the effect."""
+    if status == "success":
+        return True
+    if failure_class in CONTENT_FAILURES:
+        return False
+    return None
+
+
+def _is_failing(effect_id: str) -> bool:
+    window = _outcomes.get(effect_id)
+    if not window or len(window) < _min_samples:
+        return False
+    return window.count(False) / len(window) >= _failure_rate
+
+
+def record(effect_id: str, status: str, failure_class: str | None = None) -> str | None:
+    """Record one generation outcome. Returns "disabled" or "enabled" when the effect changes state."""
+    outcome = _outcome(status, failure_class)
+    if outcome is None:
+        return None
+    window = _outcomes.setdefault(effect_id, deque(maxlen=WINDOW))
+
+    if effect_id in _disabled:
+        # A probe after the cooldown (or a run already in flight when it was disabled) decides
+        if outcome:
+            del _disabled[effect_id]
+            window.clear()
+            window.append(True)
+            logger.info(f"Effect {effect_id} re-enabled after a successful probe")
+            return "enabled"
+        _disabled[effect_id] = time.monotonic()
+        logger.warning(f"Effect {effect_id} probe failed ({failure_class}), disabled for another {_cooldown:.0f}s")
+        return None
+
+    window.append(outcome)
+    if _is_failing(effect_id):
+        _disabled[effect_id] = time.monotonic()
+        logger.warning(f"Effect {effect_id} disabled: {window.count(False)}/{len(window)} recent content failures")
+        return "disabled"
+    return None
+
+
+def is_available(effect_id: str) -> bool:
+    """False while an effect is disabled and still cooling down (past the cooldown it is on probation)."""
+    disabled_at = _disabled.get(effect_id)
+    return disabled_at is None or time.monotonic() - disabled_at >= _cooldown
+
+
+def disabled() -> dict[str, float]:
+    """effect_id → seconds until its next probe (0 = on probation now), for status screens."""
+    now = time.monotonic()
+    return {effect_id: max(0.0, _cooldown - (now - at)) for effect_id, at in sorted(_disabled.items())}
+
+
+def failure_rate(effect_id: str) -> tuple[int, int]:
+    """(content failures, outcomes) in the effect's current window."""
+    window = _outcomes.get(effect_id) or ()
+    return sum(1 for ok in window if not ok), len(window)
@@ -0,0 +1,754 @@
+"""
+Gemini generation layer for Photo Bot.
+Runs image generation on the async Gemini client behind a concurrency cap,
+so a slow generation never blocks the bot's event loop. Requests are spread
+over a pool of API keys by per-key quota headroom, the concurrency cap
+adapts (AIMD) to Gemini's current capacity, and each effect's model list is
+routed to the first model meeting the latency/error SLO. Every call has a deadline, short transient failures are retried with jittered backoff within
+a retry budget, and a circuit breaker fails fast while Gemini is down.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from functools import partial
+
+import httpx
+from google import genai
+from google.genai import errors, types
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "gemini-3-pro-image-preview"
+DEFAULT_FALLBACK_MODELS = ["gemini-2.5-flash-image"]
+DEFAULT_ROUTE_P95 = 60.0         # seconds; slower models are routed around
+DEFAULT_ROUTE_ERROR_RATE = 0.3   # share of failed calls that makes a model unhealthy
+
+# Default bounds on simultaneous Gemini requests (overridden via init_generation)
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_MIN_CONCURRENCY = 1
+DEFAULT_TIMEOUT = 120.0  # seconds per Gemini call
+DEFAULT_MAX_RETRIES = 2  # in-call retries on 5xx/429/connection errors
+
+DEFAULT_KEY_RPM = None   # requests per minute per API key (None = no client-side quota; 429s still quarantine)
+DEFAULT_QUARANTINE = 60.0  # seconds a key sits out after a quota error without retryDelay
+
+# Streamed text with no image beyond this length is treated as a refusal
+REFUSAL_TEXT_CHARS = 600
+
+RETRY_BASE_DELAY = 1.0   # seconds, full jitter up to base * 2^attempt
+RETRY_MAX_DELAY = 10.0
+
+# Finish reasons that mean the model refused rather than failed
+BLOCK_FINISH_REASONS = {
+    types.FinishReason.SAFETY,
+    types.FinishReason.PROHIBITED_CONTENT,
+    types.FinishReason.BLOCKLIST,
+    types.FinishReason.SPII,
+    types.FinishReason.RECITATION,
+    types.FinishReason.IMAGE_SAFETY,
+    types.FinishReason.IMAGE_PROHIBITED_CONTENT,
+    types.FinishReason.IMAGE_RECITATION,
+}
+
+# Global key pool and limiter (set on init)
+_pool: "KeyPool | None" = None
+_limiter: "AdaptiveLimiter | None" = None
+_router: "ModelRouter | None" = None
+_timeout = DEFAULT_TIMEOUT
+_max_retries = DEFAULT_MAX_RETRIES
+_stream = True
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Gemini while the circuit breaker is open."""
+
+
+# ── API Key Pool ─────────────────────────────────────────────────────────────
+
+
+class ApiKey:
+    """One Gemini API key: its client, a token bucket for its RPM quota (if set) and quarantine state."""
+
+    def __init__(self, client: genai.Client, name: str, rpm: float | None):
+        self.client = client
+        self.name = name
+        self.unlimited = rpm is None
+        self.rate = rpm / 60.0 if rpm is not None else 0.0        # tokens per second
+        self.capacity = max(1.0, rpm / 4) if rpm is not None else 1.0  # bursts of up to a quarter-minute of quota
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.quarantined_until = 0.0
+        self.in_flight = 0
+
+    def refill(self, now: float) -> None:
+        if self.unlimited:
+            self.tokens = self.capacity
+        else:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_in(self, now: float) -> float:
+        """Seconds until this key can take a request."""
+        if now < self.quarantined_until:
+            return self.quarantined_until - now
+        if self.unlimited:
+            return 0.0
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate > 0 else float("inf")
+
+
+class KeyPool:
+    """Routes each request to the key with the most quota headroom."""
+
+    def __init__(self, clients: list[tuple[str, genai.Client]], rpm: float | None = DEFAULT_KEY_RPM):
+        if not clients:
+            raise ValueError("KeyPool needs at least one client")
+        self.keys = [ApiKey(client, name, rpm) for name, client in clients]
+
+    async def acquire(self) -> ApiKey:
+        """Take one request token from the best key, waiting if every key is spent or quarantined."""
+        while True:
+            now = time.monotonic()
+            for key in self.keys:
+                key.refill(now)
+            ready = [key for key in self.keys if key.ready_in(now) == 0]
+            if ready:
+                key = max(ready, key=lambda k: (k.tokens, -k.in_flight))
+                key.tokens -= 1
+                key.in_flight += 1
+                return key
+            await asyncio.sleep(min(key.ready_in(now) for key in self.keys))
+
+    def release(self, key: ApiKey, error: Exception | None = None) -> None:
+        """Return a key after a call; quota errors put it in quarantine."""
+        key.in_flight -= 1
+        if error is not None and isinstance(error, errors.APIError) and error.code == 429:
+            delay = _retry_delay(error) or DEFAULT_QUARANTINE
+            key.quarantined_until = time.monotonic() + delay
+            key.tokens = 0.0
+            logger.warning(f"Gemini key {key.name} quarantined for {delay:.0f}s (quota exceeded)")
+
+
+def _retry_delay(error: errors.APIError) -> float | None:
+    """retryDelay from a 429's RetryInfo detail ("37s"), if Gemini sent one."""
+    details = error.details.get("error", {}).get("details", []) if isinstance(error.details, dict) else []
+    for detail in details:
+        delay = detail.get("retryDelay") if isinstance(detail, dict) else None
+        if isinstance(delay, str) and delay.endswith("s"):
+            try:
+                return float(delay[:-1])
+            except ValueError:
+                return None
+    return None
+
+
+def parse_api_keys(value: str) -> list[str]:
+    """Split a comma-separated GEMINI_API_KEYS value."""
+    return [key.strip() for key in value.split(",") if key.strip()]
+
+
+def key_name(api_key: str) -> str:
+    """Loggable key label (last 4 characters only)."""
+    return f"…{api_key[-4:]}"
+
+
+# ── Adaptive Concurrency ─────────────────────────────────────────────────────
+
+
+class AdaptiveLimiter:
+    """AIMD cap on in-flight Gemini requests.
+
+    Each healthy response while the cap is in use adds 1/limit (about +1 per
+    full round of requests). A 429, a timeout or a latency spike (latency_factor
+    × the running baseline) multiplies the cap by `decrease`, at most once per
+    cooldown so one burst of failures counts as a single signal.
+    """
+
+    def __init__(
+        self,
+        max_limit: int = DEFAULT_MAX_CONCURRENCY,
+        min_limit: int = DEFAULT_MIN_CONCURRENCY,
+        initial: int | None = None,
+        decrease: float = 0.5,
+        latency_factor: float = 2.0,
+        cooldown: float = 10.0,
+    ):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        start = initial if initial is not None else max(self.min_limit, self.max_limit // 2)
+        self._limit = float(min(self.max_limit, max(self.min_limit, start)))
+        self._in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self._baseline: float | None = None  # EWMA of healthy latencies, seconds
+        self._samples = 0
+        self._last_decrease = 0.0
+        self.history: deque[tuple[float, int, str]] = deque(maxlen=50)  # (unix time, limit, reason)
+        self.history.append((time.time(), self.limit, "start"))
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for waiter in self._waiters if not waiter.done())
+
+    @property
+    def baseline_latency(self) -> float | None:
+        return self._baseline
+
+    async def acquire(self) -> None:
+        """Wait until a request may go out under the current limit."""
+        if self._in_flight < self.limit and not self._waiters:
+            self._in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Slot was handed over just as we were cancelled; pass it on
+                self._in_flight -= 1
+                self._wake()
+            raise
+
+    def release(self, outcome: str, latency: float | None = None) -> None:
+        """Return a slot. outcome: "ok", "overload" (429/timeout) or "error"."""
+        saturated = self._in_flight >= self.limit
+        self._in_flight -= 1
+
+        if outcome == "overload":
+            self._cut(outcome)
+        elif outcome == "ok" and latency is not None:
+            spike = (
+                self._baseline is not None
+                and self._samples >= 10
+                and latency > self.latency_factor * self._baseline
+            )
+            self._baseline = latency if self._baseline is None else 0.9 * self._baseline + 0.1 * latency
+            self._samples += 1
+            if spike:
+                self._cut(f"latency {latency:.1f}s")
+            elif saturated and self._limit < self.max_limit:
+                before = self.limit
+                self._limit = min(float(self.max_limit), self._limit + 1 / self._limit)
+                if self.limit != before:
+                    self.history.append((time.time(), self.limit, "healthy"))
+
+        self._wake()
+
+    def _cut(self, reason: str) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        before = self.limit
+        self._limit = max(float(self.min_limit), self._limit * self.decrease)
+        if self.limit != before:
+            logger.warning(f"Gemini concurrency limit {before} → {self.limit} ({reason})")
+            self.history.append((time.time(), self.limit, reason))
+
+    def _wake(self) -> None:
+        while self._waiters and self._in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._in_flight += 1
+                waiter.set_result(None)
+
+
+# ── Model Routing ────────────────────────────────────────────────────────────
+
+
+class ModelRouter:
+    """Routes to the first model in a preference list that meets the SLO.
+
+    Stats are a time window, so a model that was routed around loses its bad
+    samples after `window` seconds and gets traffic again.
+    """
+
+    def __init__(
+        self,
+        p95_threshold: float = DEFAULT_ROUTE_P95,
+        max_error_rate: float = DEFAULT_ROUTE_ERROR_RATE,
+        window: float = 300.0,
+        min_samples: int = 10,
+    ):
+        self.p95_threshold = p95_threshold
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: dict[str, deque[tuple[float, float | None]]] = {}  # model → (time, latency or None on error)
+
+    def record(self, model: str, latency: float | None) -> None:
+        """Record a call: its latency in seconds, or None if it failed."""
+        self._samples.setdefault(model, deque()).append((time.monotonic(), latency))
+
+    def stats(self, model: str) -> dict:
+        """Window stats for a model: count, p95 (seconds, or None) and error_rate."""
+        samples = self._samples.get(model, deque())
+        now = time.monotonic()
+        while samples and now - samples[0][0] > self.window:
+            samples.popleft()
+        latencies = sorted(latency for _, latency in samples if latency is not None)
+        count = len(samples)
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] if latencies else None
+        error_rate = (count - len(latencies)) / count if count else 0.0
+        return {"count": count, "p95": p95, "error_rate": error_rate}
+
+    def healthy(self, model: str) -> bool:
+        stats = self.stats(model)
+        if stats["count"] < self.min_samples:
+            return True
+        if stats["error_rate"] > self.max_error_rate:
+            return False
+        return stats["p95"] is None or stats["p95"] <= self.p95_threshold
+
+    def choose(self, models: list[str]) -> str:
+        """First healthy model in preference order (the primary if none is healthy)."""
+        for model in models:
+            if self.healthy(model):
+                if model != models[0]:
+                    logger.info(f"Routing around {models[0]} to fallback {model}")
+                return model
+        return models[0]
+
+    def models(self) -> list[str]:
+        """Models that have recorded calls."""
+        return list(self._samples)
+
+
+# ── Circuit Breaker ──────────────────────────────────────────────────────────
+
+
+class CircuitBreaker:
+    """Opens after consecutive transient failures, then lets one probe through
+    every reset_timeout seconds until a call succeeds again."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if self._probing or time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> tuple[bool, bool]:
+        """(call may go out now, call took the probe slot); the probe slot is taken when half-open."""
+        state = self.state
+        if state == "closed":
+            return True, False
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True, True
+        return False, False
+
+    def record_success(self) -> None:
+        if self._opened_at is not None:
+            logger.info("Gemini circuit closed")
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def cancel_probe(self) -> None:
+        """Give the probe slot back when the call that took it (see allow) was cancelled or gave up."""
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._probing or (self._opened_at is None and self._failures >= self.failure_threshold):
+            logger.warning(f"Gemini circuit open after {self._failures} consecutive failures")
+            self._opened_at = time.monotonic()
+        self._probing = False
+
+
+class RetryBudget:
+    """Caps retries at a fraction of recent calls so retries can't pile onto an outage."""
+
+    def __init__(self, ratio: float = 0.2, min_retries: int = 3, window: float = 60.0):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self._calls: deque[float] = deque()
+        self._retries: deque[float] = deque()
+
+    def _trim(self, now: float) -> None:
+        for events in (self._calls, self._retries):
+            while events and now - events[0] > self.window:
+                events.popleft()
+
+    def record_call(self) -> None:
+        self._calls.append(time.monotonic())
+
+    def try_spend(self) -> bool:
+        """Take one retry from the budget; False if the budget is exhausted."""
+        now = time.monotonic()
+        self._trim(now)
+        if len(self._retries) >= max(self.min_retries, self.ratio * len(self._calls)):
+            return False
+        self._retries.append(now)
+        return True
+
+
+_breaker = CircuitBreaker()
+_budget = RetryBudget()
+
+
+# ── Generation Profiles ──────────────────────────────────────────────────────
+
+# Effect keys that make up a generation profile
+PROFILE_KEYS = ("image_size", "aspect_ratio", "image_only", "safety")
+
+IMAGE_SIZES = ("1K", "2K", "4K")
+ASPECT_RATIOS = ("1:1", "2:3", "3:2", "3:4", "4:3", "4:5", "5:4", "9:16", "16:9", "21:9")
+SAFETY_THRESHOLDS = ("BLOCK_LOW_AND_ABOVE", "BLOCK_MEDIUM_AND_ABOVE", "BLOCK_ONLY_HIGH", "BLOCK_NONE", "OFF")
+SAFETY_CATEGORIES = ("harassment", "hate_speech", "sexually_explicit", "dangerous_content")
+
+# Only these models take an output resolution tier; others get the rest of the profile
+IMAGE_SIZE_MODEL_PREFIXES = ("gemini-3",)
+
+
+def effect_profile(effect: dict) -> dict:
+    """The generation-profile keys set on an effect (effects.yaml entry)."""
+    return {key: effect[key] for key in PROFILE_KEYS if effect.get(key) is not None}
+
+
+def validate_profile(profile: dict) -> None:
+    """Raise ValueError if a profile has an unknown tier, ratio or safety threshold.
+
+    safety is either one threshold for every category or a mapping of
+    category (harassment, hate_speech, ...) to threshold.
+    """
+    if profile.get("image_size") not in (None, *IMAGE_SIZES):
+        raise ValueError(f"image_size must be one of {', '.join(IMAGE_SIZES)}")
+    if profile.get("aspect_ratio") not in (None, *ASPECT_RATIOS):
+        raise ValueError(f"aspect_ratio must be one of {', '.join(ASPECT_RATIOS)}")
+    safety = profile.get("safety")
+    if safety is None:
+        return
+    if isinstance(safety, dict):
+        if not set(safety) <= set(SAFETY_CATEGORIES):
+            raise ValueError(f"safety categories must be among {', '.join(SAFETY_CATEGORIES)}")
+        thresholds = list(safety.values())
+    else:
+        thresholds = [safety]
+    if any(threshold not in SAFETY_THRESHOLDS for threshold in thresholds):
+        raise ValueError(f"safety thresholds must be one of {', '.join(SAFETY_THRESHOLDS)}")
+
+
+def build_config(profile: dict | None = None, model: str | None = None) -> types.GenerateContentConfig:
+    """GenerateContentConfig for a generation profile (see effect_profile).
+
+    An empty profile gives the default: text + image output, model-default
+    resolution, aspect ratio and safety. image_size is dropped for models
+    that don't support resolution tiers, so a fallback model still works.
+    """
+    profile = profile or {}
+    image_config = {}
+    if profile.get("aspect_ratio"):
+        image_config["aspect_ratio"] = profile["aspect_ratio"]
+    if profile.get("image_size") and (model is None or model.startswith(IMAGE_SIZE_MODEL_PREFIXES)):
+        image_config["image_size"] = profile["image_size"]
+
+    safety = profile.get("safety")
+    if isinstance(safety, str):
+        safety = dict.fromkeys(SAFETY_CATEGORIES, safety)
+
+    return types.GenerateContentConfig(
+        response_modalities=["Image"] if profile.get("image_only") else ["Text", "Image"],
+        image_config=types.ImageConfig(**image_config) if image_config else None,
+        safety_settings=[
+            types.SafetySetting(category=f"HARM_CATEGORY_{category.upper()}", threshold=threshold)
+            for category, threshold in safety.items()
+        ] if safety else None,
+    )
+
+
+# ── Generation ───────────────────────────────────────────────────────────────
+
+
+def init_generation(
+    clients: genai.Client | list[tuple[str, genai.Client]],
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    timeout: float = DEFAULT_TIMEOUT,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    min_concurrency: int = DEFAULT_MIN_CONCURRENCY,
+    key_rpm: float | None = DEFAULT_KEY_RPM,
+    route_p95: float = DEFAULT_ROUTE_P95,
+    route_error_rate: float = DEFAULT_ROUTE_ERROR_RATE,
+    stream: bool = True,
+) -> None:
+    """Initialize generation layer with Gemini clients, concurrency bounds and call policy.
+
+    clients is a single client or a list of (key label, client) pairs, one per API key.
+    With stream=True responses are streamed so refusals end the call early.
+    """
+    global _pool, _limiter, _router, _timeout, _max_retries, _stream
+    if not isinstance(clients, list):
+        clients = [("default", clients)]
+    _pool = KeyPool(clients, key_rpm)
+    _limiter = AdaptiveLimiter(max_limit=max_concurrency, min_limit=min_concurrency)
+    _router = ModelRouter(route_p95, route_error_rate)
+    _timeout = timeout
+    _max_retries = max(0, max_retries)
+    _stream = stream
+    logger.info(
+        f"Generation layer initialized ({len(clients)} key(s) × {key_rpm or 'unlimited'} rpm, concurrency: {_limiter.limit}, "
+        f"bounds: {_limiter.min_limit}–{_limiter.max_limit}, timeout: {timeout}s, retries: {max_retries}, "
+        f"route SLO: p95 ≤ {route_p95}s, errors ≤ {route_error_rate:.0%}, streaming: {stream})"
+    )
+
+
+def route(models: list[str]) -> str:
+    """Pick the model to use from a primary + fallbacks preference list."""
+    if _router is None:
+        raise RuntimeError("Generation layer not initialized")
+    return _router.choose(models)
+
+
+def router() -> ModelRouter | None:
+    """The model router (for status screens)."""
+    return _router
+
+
+def limiter() -> AdaptiveLimiter | None:
+    """The adaptive concurrency limiter (for status screens)."""
+    return _limiter
+
+
+def api_keys() -> list[ApiKey]:
+    """API keys in the pool (for status screens)."""
+    return _pool.keys if _pool is not None else []
+
+
+def circuit_state() -> str:
+    """Gemini circuit breaker state: closed, open or half_open."""
+    return _breaker.state
+
+
+def in_flight() -> int:
+    """Number of Gemini requests currently running."""
+    return _limiter.in_flight if _limiter is not None else 0
+
+
+def image_part(data: bytes, mime_type: str) -> types.Part:
+    """Wrap encoded image bytes for use as generation input."""
+    return types.Part.from_bytes(data=data, mime_type=mime_type)
+
+
+async def generate_content(model: str, prompt: str, image, config: types.GenerateContentConfig | None = None):
+    """Run one Gemini generation on the async client. Returns the raw response.
+
+    image is a types.Part (see image_part) or a PIL image; config comes from
+    build_config (default profile if omitted). Waits for a free
+    slot when the adaptive concurrency limit is reached. 5xx/429/connection
+    errors are retried in place; timeouts and everything else are raised, as is
+    CircuitOpenError while Gemini is known to be down. Responses are never
+    retried here, including safety blocks and responses without an image.
+    """
+    if _pool is None or _limiter is None:
+        raise RuntimeError("Generation layer not initialized")
+
+    if config is None:
+        config = build_config(model=model)
+
+    allowed, probe = _breaker.allow()
+    if not allowed:
+        raise CircuitOpenError("Gemini circuit is open")
+    _budget.record_call()
+
+    attempt = 0
+    while True:
+        try:
+            # Key quota first: a call waiting for quota must not hold a concurrency slot,
+            # or the limiter would read quota blocking as saturation
+            key = await _pool.acquire()
+            key_error = None
+            try:
+                await _limiter.acquire()
+                outcome = "error"
+                started = time.monotonic()
+                try:
+                    try:
+                        if _stream:
+                            call = partial(_stream_content, key.client)
+                        else:
+                            call = key.client.aio.models.generate_content
+                        response = await asyncio.wait_for(
+                            call(model=model, contents=[prompt, image], config=config),
+                            timeout=_timeout,
+                        )
+                    except Exception as e:
+                        key_error = e
+                        if is_transient_error(e):
+                            _router.record(model, None)
+                        raise
+                    _router.record(model, time.monotonic() - started)
+                    outcome = "ok"
+                except Exception as e:
+                    if is_overload_error(e):
+                        outcome = "overload"
+                    raise
+                finally:
+                    elapsed = time.monotonic() - started
+                    _limiter.release(outcome, elapsed)
+                    metrics.inc("photobot_gemini_requests_total", model=model, outcome=outcome)
+                    if outcome == "ok":
+                        metrics.observe("photobot_gemini_seconds", elapsed, model=model)
+            finally:
+                _pool.release(key, key_error)
+        except asyncio.CancelledError:
+            if probe:
+                _breaker.cancel_probe()
+            raise
+        except Exception as e:
+            if not is_transient_error(e):
+                _breaker.record_success()  # Gemini answered; the request itself was rejected
+                raise
+            _breaker.record_failure()
+            # A timeout already cost a full deadline; leave it to the caller's job retry
+            if isinstance(e, asyncio.TimeoutError) or attempt >= _max_retries:
+                raise
+            allowed, probe = _breaker.allow()
+            if not allowed:
+                raise
+            if not _budget.try_spend():
+                if probe:
+                    _breaker.cancel_probe()
+                raise
+            attempt += 1
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            logger.warning(f"Gemini call failed ({e}), retry {attempt}/{_max_retries} in {delay:.1f}s")
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                if probe:
+                    _breaker.cancel_probe()
+                raise
+            continue
+
+        _breaker.record_success()
+        return response
+
+
+async def _stream_content(client: genai.Client, model: str, contents, config) -> types.GenerateContentResponse:
+    """Stream one generation and merge the chunks into a single response.
+
+    Stops reading as soon as the stream shows a refusal (block reason, blocking
+    finish reason, or REFUSAL_TEXT_CHARS of text and still no image), so a
+    refused request gives its slot back without waiting for the full answer.
+    """
+    stream = await client.aio.models.generate_content_stream(model=model, contents=contents, config=config)
+    text = ""
+    images: list[types.Part] = []
+    finish_reason = None
+    prompt_feedback = None
+    usage_metadata = None
+    model_version = None
+    try:
+        async for chunk in stream:
+            prompt_feedback = chunk.prompt_feedback or prompt_feedback
+            usage_metadata = chunk.usage_metadata or usage_metadata
+            model_version = chunk.model_version or model_version
+            candidate = chunk.candidates[0] if chunk.candidates else None
+            if candidate is not None:
+                finish_reason = candidate.finish_reason or finish_reason
+                parts = candidate.content.parts if candidate.content else None
+                for part in parts or []:
+                    if part.thought:
+                        continue
+                    if part.inline_data is not None:
+                        images.append(part)
+                    elif part.text:
+                        text += part.text
+
+            if (prompt_feedback is not None and prompt_feedback.block_reason) or finish_reason in BLOCK_FINISH_REASONS:
+                logger.info(f"Gemini stream blocked early ({model}): {finish_reason or prompt_feedback.block_reason}")
+                break
+            if not images and len(text) > REFUSAL_TEXT_CHARS:
+                logger.info(f"Gemini stream looks like a text-only refusal ({model}), stopping early")
+                break
+    finally:
+        await stream.aclose()
+
+    parts = ([types.Part(text=text)] if text else []) + images
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=parts), finish_reason=finish_reason)],
+        prompt_feedback=prompt_feedback,
+        usage_metadata=usage_metadata,
+        model_version=model_version,
+    )
+
+
+def blocked_reason(response) -> str | None:
+    """Why Gemini refused to generate (e.g. "SAFETY"), or None if it didn't."""
+    feedback = response.prompt_feedback
+    if feedback is not None and feedback.block_reason:
+        return feedback.block_reason.value
+    for candidate in response.candidates or []:
+        if candidate.finish_reason in BLOCK_FINISH_REASONS:
+            return candidate.finish_reason.value
+    return None
+
+
+metrics.gauge("photobot_gemini_in_flight", in_flight)
+metrics.gauge("photobot_gemini_concurrency_limit", lambda: _limiter.limit if _limiter is not None else 0)
+
+
+def is_overload_error(error: Exception) -> bool:
+    """True when Gemini is telling us to send less: 429 or a blown deadline."""
+    if isinstance(error, errors.APIError) and error.code == 429:
+        return True
+    return isinstance(error, asyncio.TimeoutError)
+
+
+def failure_class(error: Exception) -> str:
+    """Short failure category for telemetry (timeout, overload, server_error, ...)."""
+    if isinstance(error, CircuitOpenError):
+        return "circuit_open"
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(error, errors.APIError):
+        if error.code == 429:
+            return "overload"
+        return "server_error" if isinstance(error, errors.ServerError) else "client_error"
+    if isinstance(error, (ConnectionError, httpx.TransportError)):
+        return "network"
+    return "internal"
+
+
+def usage_tokens(response) -> dict:
+    """Token usage of a response as prompt_tokens / output_tokens / total_tokens (None if unknown)."""
+    usage = getattr(response, "usage_metadata", None)
+    return {
+        "prompt_tokens": getattr(usage, "prompt_token_count", None),
+        "output_tokens": getattr(usage, "candidates_token_count", None),
+        "total_tokens": getattr(usage, "total_token_count", None),
+    }
+
+
+def is_transient_error(error: Exception) -> bool:
+    """True for failures worth retrying later: Gemini 5xx/429, timeouts, network errors."""
+    if isinstance(error, (errors.ServerError, CircuitOpenError)):
+        return True
+    if isinstance(error, errors.APIError) and error.code == 429:
+        return True
+    return isinstance(error, (asyncio.TimeoutError, ConnectionError, httpx.TransportError))
@@ -0,0 +1,204 @@
+"""
+Image processing helpers for Photo Bot.
+Input preprocessing shared by the bot and drop_pipeline (bounded resolution,
+cheap JPEG draft-mode decode and EXIF orientation fix before Gemini), result
+delivery that uploads Gemini's bytes unchanged unless Telegram needs a
+different format, size-capped derivatives of the bundled example images,
+and category preview collages.
+"""
+
+import hashlib
+import io
+import os
+
+from PIL import ExifTags, Image, ImageOps
+
+# Long-side cap for photos sent to Gemini (effects may override via max_input_side)
+DEFAULT_MAX_INPUT_SIDE = 1280
+INPUT_JPEG_QUALITY = 90
+
+# Formats Gemini accepts as-is when no resize or rotation is needed
+PASSTHROUGH_MIME_TYPES = {"image/jpeg", "image/png", "image/webp"}
+
+
+def preprocess_input(data: bytes, max_side: int = DEFAULT_MAX_INPUT_SIDE) -> tuple[bytes, str]:
+    """Prepare a photo for Gemini. Returns (image_bytes, mime_type).
+
+    Photos that are already within max_side and upright pass through unchanged.
+    Larger JPEGs are decoded in draft mode (DCT scaling, 1/2–1/8 size) before
+    the final resize, which avoids decoding every pixel of a 12 MP upload.
+    """
+    image = Image.open(io.BytesIO(data))
+    mime_type = Image.MIME.get(image.format or "")
+    orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+
+    if max(image.size) <= max_side and orientation == 1 and mime_type in PASSTHROUGH_MIME_TYPES:
+        return data, mime_type
+
+    if image.format == "JPEG":
+        image.draft("RGB", (max_side, max_side))
+    image = ImageOps.exif_transpose(image)
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=INPUT_JPEG_QUALITY)
+    return buf.getvalue(), "image/jpeg"
+
+
+# ── Result Delivery ──────────────────────────────────────────────────────────
+
+# Formats Telegram's sendPhoto takes as-is, and its photo size limit
+TELEGRAM_PHOTO_MIME_TYPES = {"image/jpeg", "image/png"}
+TELEGRAM_PHOTO_MAX_BYTES = 10 * 1024 * 1024
+TELEGRAM_PHOTO_MAX_DIMENSIONS = 10000  # width + height
+OUTPUT_MIN_QUALITY = 70      # JPEG quality is stepped down to this before a too-large result is downscaled
+OUTPUT_DOWNSCALE_STEP = 0.8  # side scale per downscale step
+
+OUTPUT_FORMATS = {"jpeg": ("JPEG", "image/jpeg", "jpg"), "png": ("PNG", "image/png", "png")}
+
+
+def prepare_output(
+    data: bytes,
+    mime_type: str | None,
+    output_format: str = "original",
+    quality: int = 90,
+) -> tuple[bytes, str]:
+    """Bytes to upload for a generated image. Returns (image_bytes, filename).
+
+    With output_format="original" the model's bytes are sent unchanged whenever
+    Telegram accepts them; anything else (WebP, >10 MB, ...) is transcoded to JPEG.
+    output_format="jpeg"/"png" always transcodes unless the bytes already match.
+    A transcoded image that is still over Telegram's photo limit gets a lower
+    JPEG quality (down to OUTPUT_MIN_QUALITY), then is downscaled until it fits.
+    """
+    target = OUTPUT_FORMATS.get(output_format)
+    if target is None:
+        if mime_type in TELEGRAM_PHOTO_MIME_TYPES and len(data) <= TELEGRAM_PHOTO_MAX_BYTES:
+            return data, f"result.{mime_type.split('/')[1].replace('jpeg', 'jpg')}"
+        target = OUTPUT_FORMATS["jpeg"]
+
+    pil_format, target_mime, ext = target
+    if mime_type == target_mime and len(data) <= TELEGRAM_PHOTO_MAX_BYTES:
+        return data, f"result.{ext}"
+
+    image = Image.open(io.BytesIO(data))
+    if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    if image.width + image.height > TELEGRAM_PHOTO_MAX_DIMENSIONS:
+        scale = TELEGRAM_PHOTO_MAX_DIMENSIONS / (image.width + image.height)
+        image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.LANCZOS)
+
+    output = _encode(image, pil_format, quality)
+    while len(output) > TELEGRAM_PHOTO_MAX_BYTES:
+        if pil_format == "JPEG" and quality > OUTPUT_MIN_QUALITY:
+            quality = max(OUTPUT_MIN_QUALITY, quality - 10)
+        else:
+            size = (max(1, int(image.width * OUTPUT_DOWNSCALE_STEP)), max(1, int(image.height * OUTPUT_DOWNSCALE_STEP)))
+            image = image.resize(size, Image.LANCZOS)
+        output = _encode(image, pil_format, quality)
+    return output, f"result.{ext}"
+
+
+def _encode(image: Image.Image, pil_format: str, quality: int) -> bytes:
+    buf = io.BytesIO()
+    image.save(buf, format=pil_format, quality=quality)
+    return buf.getvalue()
+
+
+# ── Asset Derivatives ────────────────────────────────────────────────────────
+
+# Cache of delivery copies of images/ (relative to the repo root; not committed)
+DERIVATIVE_SUBDIR = os.path.join(".cache", "derivatives")
+DERIVATIVE_MAX_SIDE = 1280  # Telegram never shows a photo larger than this
+DERIVATIVE_QUALITY = 85
+# sendPhoto takes JPEG; WebP suits other consumers (e.g. previews outside Telegram)
+DERIVATIVE_FORMATS = {"jpeg": ("JPEG", "jpg"), "webp": ("WEBP", "webp")}
+
+
+def build_derivative(
+    source: str,
+    cache_dir: str,
+    max_side: int = DERIVATIVE_MAX_SIDE,
+    quality: int = DERIVATIVE_QUALITY,
+    fmt: str = "jpeg",
+) -> str:
+    """Path of a size-capped, re-encoded copy of source in cache_dir, built if missing.
+
+    The file name carries the source's content hash and the settings, so an
+    unchanged image is only hashed and a replaced one gets a new derivative.
+    """
+    with open(source, "rb") as f:
+        data = f.read()
+    pil_format, ext = DERIVATIVE_FORMATS[fmt]
+    stem = os.path.splitext(os.path.basename(source))[0]
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    path = os.path.join(cache_dir, f"{stem}-{digest}-{max_side}q{quality}.{ext}")
+    if os.path.exists(path):
+        return path
+
+    image = Image.open(io.BytesIO(data))
+    if image.format == "JPEG":
+        image.draft("RGB", (max_side, max_side))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    if image.mode in ("RGBA", "LA", "P"):
+        # Flatten transparency onto white rather than black
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+
+    buf = io.BytesIO()
+    image.save(buf, format=pil_format, quality=quality, optimize=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(buf.getvalue())
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def build_derivatives(sources: list[str], cache_dir: str, prune: bool = False, **settings) -> dict[str, str]:
+    """source → derivative path for every source, building only what is missing.
+
+    With prune=True, cached files no source maps to any more are deleted
+    (pass the complete set of sources then).
+    """
+    derivatives = {source: build_derivative(source, cache_dir, **settings) for source in dict.fromkeys(sources)}
+    if prune and os.path.isdir(cache_dir):
+        keep = {os.path.basename(path) for path in derivatives.values()}
+        for name in os.listdir(cache_dir):
+            if name not in keep:
+                os.remove(os.path.join(cache_dir, name))
+    return derivatives
+
+
+# ── Category Collages ────────────────────────────────────────────────────────
+
+COLLAGE_TILE = (300, 400)  # width, height of one thumbnail (example images are portrait)
+COLLAGE_MAX_COLUMNS = 3
+COLLAGE_QUALITY = 85
+
+
+def compose_collage(paths: list[str], tile: tuple[int, int] = COLLAGE_TILE) -> bytes:
+    """JPEG grid of center-cropped thumbnails, in the given order. Returns the JPEG bytes.
+
+    Two to four images are laid out two per row, more three per row.
+    """
+    columns = 2 if len(paths) <= 4 else COLLAGE_MAX_COLUMNS
+    rows = -(-len(paths) // columns)
+    canvas = Image.new("RGB", (columns * tile[0], rows * tile[1]), "white")
+    for i, path in enumerate(paths):
+        with Image.open(path) as image:
+            if image.format == "JPEG":
+                image.draft("RGB", tile)
+            thumb = ImageOps.fit(ImageOps.exif_transpose(image).convert("RGB"), tile, Image.LANCZOS)
+        canvas.paste(thumb, ((i % columns) * tile[0], (i // columns) * tile[1]))
+
+    buf = io.BytesIO()
+    canvas.save(buf, format="JPEG", quality=COLLAGE_QUALITY, optimize=True)
+    return buf.getvalue()
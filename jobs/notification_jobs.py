@@ -21,9 +21,11 @@ from datetime import datetime
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from telegram import Bot
+from telegram.ext import ExtBot
 from dotenv import load_dotenv
 import database as db
 import notifications as notif
+import ratelimit
 
 # Load environment
 load_dotenv(Path(__file__).parent.parent / ".env")
@@ -31,6 +33,8 @@ load_dotenv(Path(__file__).parent.parent / ".env")
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 BOT_USERNAME = os.getenv("BOT_USERNAME")
 ADMIN_ID = int(os.getenv("ADMIN_ID", 0))
+# Messages per second for this job; the running bot shares Telegram's ~30/s with it
+NOTIFY_RATE = float(os.getenv("NOTIFY_RATE", 10))
 
 # Package info for N9 abandoned payment messages
 PACKAGES = {
@@ -46,7 +50,7 @@ async def run_daily_jobs():
     print(f"📅 Running daily notification jobs at {datetime.now()}")
 
     # Initialize bot and notification system
-    bot = Bot(token=BOT_TOKEN)
+    bot = ExtBot(token=BOT_TOKEN, rate_limiter=ratelimit.TelegramRateLimiter(overall_rate=NOTIFY_RATE))
     notif.init_notifications(bot)
 
     # Run jobs and collect results
@@ -69,7 +73,9 @@ async def send_welcome_reminders() -> int:
     """
     N1: Send welcome reminders to inactive new users.
 
-    Trigger: created_at <= now-24h AND gen_count = 0 AND credits > 0
+    Trigger: created_at <= now-24h AND gen_count = 0 AND available balance > 0
+    (credits minus holds of pending generations, as db.get_balance; a user whose
+    credits are all held by a generation in progress is skipped)
     """
     conn = db.get_connection()
     cursor = conn.cursor()
@@ -89,14 +95,17 @@ async def send_welcome_reminders() -> int:
 
     sent_count = 0
     for user in users:
+        # Spendable balance, as the bot shows it (credits held by pending generations excluded)
+        balance = db.get_balance(user['telegram_id'])
+        if balance <= 0:
+            continue
         success = await notif.send_welcome_reminder(
             user['telegram_id'],
             user['username'],
-            user['credits']
+            balance
         )
         if success:
             sent_count += 1
-        await asyncio.sleep(0.1)
 
     print(f"✅ N1: Sent {sent_count}/{len(users)}")
     return sent_count
@@ -131,7 +140,6 @@ async def send_zero_balance_silent() -> int:
         success = await notif.send_zero_balance_silent(user['telegram_id'])
         if success:
             sent_count += 1
-        await asyncio.sleep(0.1)
 
     print(f"✅ N10: Sent {sent_count}/{len(users)}")
     return sent_count
@@ -168,7 +176,6 @@ async def send_winback_offers() -> int:
         success = await notif.send_winback_offer(user['telegram_id'])
         if success:
             sent_count += 1
-        await asyncio.sleep(0.1)
 
     print(f"✅ N4: Sent {sent_count}/{len(users)}")
     return sent_count
@@ -217,8 +224,6 @@ async def send_abandoned_payment_reminders() -> int:
             conn.commit()
             conn.close()
 
-        await asyncio.sleep(0.1)
-
     print(f"✅ N9: Sent {sent_count}/{len(invoices)}")
     return sent_count
 
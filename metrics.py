@@ -0,0 +1,162 @@
+"""
+In-memory metrics for Photo Bot.
+Rolling windows of recent durations per generation stage and per effect,
+summarised as p50/p95/p99 for the admin panel, plus process-wide counters,
+histograms and gauges rendered in Prometheus text format for /metrics.
+"""
+
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable
+
+# Generation stages in pipeline order (total = job start to result delivered)
+STAGES = ("queue", "download", "preprocess", "gemini", "encode", "upload", "total")
+
+# Samples kept per stage (and per effect + stage)
+WINDOW = 500
+
+_samples: dict[tuple[str | None, str], deque[float]] = {}
+
+
+def record(stage: str, seconds: float, effect_id: str | None = None) -> None:
+    """Record one stage duration, overall and for the effect if given."""
+    observe("photobot_generation_stage_seconds", seconds, stage=stage)
+    _samples.setdefault((None, stage), deque(maxlen=WINDOW)).append(seconds)
+    if effect_id is not None:
+        _samples.setdefault((effect_id, stage), deque(maxlen=WINDOW)).append(seconds)
+
+
+class Timing:
+    """Result of a timer() block; seconds is set when the block completes."""
+
+    seconds: float = 0.0
+
+
+@contextmanager
+def timer(stage: str, effect_id: str | None = None):
+    """Time a block and record it. Blocks that raise are not recorded."""
+    timing = Timing()
+    start = time.perf_counter()
+    yield timing
+    timing.seconds = time.perf_counter() - start
+    record(stage, timing.seconds, effect_id)
+
+
+def percentile(ordered: list[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summary(stage: str, effect_id: str | None = None) -> dict | None:
+    """count/p50/p95/p99 (seconds) for a stage, or None if nothing recorded."""
+    samples = _samples.get((effect_id, stage))
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "p50": percentile(ordered, 50),
+        "p95": percentile(ordered, 95),
+        "p99": percentile(ordered, 99),
+    }
+
+
+def effects() -> list[str]:
+    """Effect ids that have recorded samples."""
+    return sorted({effect_id for effect_id, _ in _samples if effect_id is not None})
+
+
+# ── Prometheus ───────────────────────────────────────────────────────────────
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# name → (type, help); only names listed here are exported
+METRICS = {
+    "photobot_updates_total": ("counter", "Telegram updates processed, by update type"),
+    "photobot_update_seconds": ("histogram", "Time to process one Telegram update, by update type"),
+    "photobot_updates_in_progress": ("gauge", "Telegram updates whose handlers are running"),
+    "photobot_updates_waiting": ("gauge", "Telegram updates waiting for the same user's earlier update or a free handler slot"),
+    "photobot_gemini_requests_total": ("counter", "Gemini calls, by model and outcome (ok, overload, error)"),
+    "photobot_gemini_seconds": ("histogram", "Gemini call latency, by model"),
+    "photobot_gemini_in_flight": ("gauge", "Gemini calls currently running"),
+    "photobot_gemini_concurrency_limit": ("gauge", "Current adaptive Gemini concurrency limit"),
+    "photobot_generation_queue_depth": ("gauge", "Generation jobs waiting for a worker (incl. delayed retries)"),
+    "photobot_generation_active": ("gauge", "Generation jobs currently running"),
+    "photobot_generation_eta_seconds": ("gauge", "Estimated time until a newly submitted generation finishes"),
+    "photobot_generation_stage_seconds": ("histogram", "Generation stage duration, by stage"),
+    "photobot_db_query_seconds": ("histogram", "SQLite statement execution time"),
+    "photobot_notifications_total": ("counter", "Notification sends, by status (sent, failed)"),
+    "photobot_telegram_retry_after_total": ("counter", "Bot API calls answered with RetryAfter (flood control), by endpoint"),
+    "photobot_telegram_rate_limited": ("gauge", "Bot API calls waiting for a global rate-limiter slot"),
+    "photobot_event_loop_lag_seconds": ("histogram", "How late the event loop woke a periodic probe"),
+}
+
+_counters: dict[str, dict[tuple, float]] = {}
+_histograms: dict[str, dict[tuple, list]] = {}  # labels → [per-bucket counts..., +Inf count, sum]
+_gauges: dict[str, Callable[[], float]] = {}
+
+
+def inc(name: str, value: float = 1.0, **labels) -> None:
+    """Add to a counter."""
+    key = tuple(sorted(labels.items()))
+    series = _counters.setdefault(name, {})
+    series[key] = series.get(key, 0.0) + value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Add an observation to a histogram."""
+    key = tuple(sorted(labels.items()))
+    series = _histograms.setdefault(name, {})
+    counts = series.get(key)
+    if counts is None:
+        counts = series[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+    for i, bound in enumerate(BUCKETS):
+        if value <= bound:
+            counts[i] += 1
+            break
+    else:
+        counts[len(BUCKETS)] += 1
+    counts[-1] += value
+
+
+def gauge(name: str, read: Callable[[], float]) -> None:
+    """Register a gauge whose value is read at scrape time."""
+    _gauges[name] = read
+
+
+def _labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def render() -> str:
+    """All registered metrics in Prometheus text exposition format."""
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        if kind == "counter" and name in _counters:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for key, value in _counters[name].items():
+                lines.append(f"{name}{_labels(key)} {value}")
+        elif kind == "histogram" and name in _histograms:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for key, counts in _histograms[name].items():
+                cumulative = 0
+                for bound, count in zip(BUCKETS, counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(key, (('le', bound),))} {cumulative}")
+                cumulative += counts[len(BUCKETS)]
+                lines.append(f"{name}_bucket{_labels(key, (('le', '+Inf'),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(key)} {counts[-1]}")
+                lines.append(f"{name}_count{_labels(key)} {cumulative}")
+        elif kind == "gauge" and name in _gauges:
+            try:
+                value = _gauges[name]()
+            except Exception:
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
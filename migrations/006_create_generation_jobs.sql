@@ -0,0 +1,23 @@
+-- Migration: Create durable generation job queue
+-- Date: 2026-10-17
+-- Description: Persist each generation request so restarts don't lose paid work
+
+CREATE TABLE IF NOT EXISTS generation_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    effect_id TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    photo_file_id TEXT NOT NULL,
+    previous_category TEXT,
+    status_message_id INTEGER,
+    anchor_message_id INTEGER,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_jobs_state ON generation_jobs(state);
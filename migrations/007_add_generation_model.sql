@@ -0,0 +1,5 @@
+-- Migration: Record the Gemini model per generation
+-- Date: 2026-10-17
+-- Description: Model each generation was routed to, for per-model latency/error stats
+
+ALTER TABLE generations ADD COLUMN model TEXT;
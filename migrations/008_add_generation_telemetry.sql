@@ -0,0 +1,13 @@
+-- Migration: Per-generation telemetry
+-- Date: 2026-10-17
+-- Description: Durations, payload sizes, token usage and failure class for latency/cost analysis.
+-- Existing rows keep NULL in every new column.
+
+ALTER TABLE generations ADD COLUMN duration_ms INTEGER;
+ALTER TABLE generations ADD COLUMN gemini_ms INTEGER;
+ALTER TABLE generations ADD COLUMN input_bytes INTEGER;
+ALTER TABLE generations ADD COLUMN output_bytes INTEGER;
+ALTER TABLE generations ADD COLUMN prompt_tokens INTEGER;
+ALTER TABLE generations ADD COLUMN output_tokens INTEGER;
+ALTER TABLE generations ADD COLUMN total_tokens INTEGER;
+ALTER TABLE generations ADD COLUMN failure_class TEXT;
@@ -0,0 +1,5 @@
+-- Migration: Multi-variant generation jobs
+-- Date: 2026-10-17
+-- Description: Number of images generated in parallel from one upload (one credit each).
+
+ALTER TABLE generation_jobs ADD COLUMN variants INTEGER NOT NULL DEFAULT 1;
@@ -0,0 +1,20 @@
+-- Migration: Credit holds
+-- Date: 2026-10-17
+-- Description: Reserve credits at request time, charge them on delivery, release them on failure.
+-- Available balance = users.credits - reserved holds. Queued jobs from before this
+-- migration get their upfront deduction converted into a hold at startup (sweep_holds).
+
+CREATE TABLE IF NOT EXISTS credit_holds (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    charged INTEGER,
+    state TEXT NOT NULL DEFAULT 'reserved',
+    expires_at TIMESTAMP NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_holds_user_state ON credit_holds(user_id, state);
+
+ALTER TABLE generation_jobs ADD COLUMN hold_id INTEGER;
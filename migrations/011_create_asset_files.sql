@@ -0,0 +1,13 @@
+-- Migration: Asset file_id registry
+-- Date: 2026-10-17
+-- Description: Telegram file_id returned by the first upload of each local image
+-- (logo, category and example images), keyed by path and content hash, so later
+-- sends reuse it instead of uploading the file again.
+
+CREATE TABLE IF NOT EXISTS asset_files (
+    path TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (path, content_hash)
+);
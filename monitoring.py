@@ -0,0 +1,206 @@
+"""
+Process monitoring for Photo Bot.
+An optional HTTP endpoint served from the bot's own event loop (Prometheus
+/metrics, /healthz liveness, /readyz readiness), an event-loop lag probe and
+an update processor that handles users' updates concurrently (each user's in
+order) and counts and times every Telegram update.
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+from telegram import Update
+from telegram.ext import SimpleUpdateProcessor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG_INTERVAL = 0.5  # seconds between event-loop lag probes
+LIVENESS_MAX_LAG = 5.0   # /healthz fails when the loop is this late (or the probe stalls this long)
+MAX_PENDING_UPDATES = 1024  # updates accepted by the update processor before it stops taking more
+
+# Probe state and server (set on start)
+_last_probe = 0.0
+_last_lag = 0.0
+_lag_task: asyncio.Task | None = None
+_server: asyncio.Server | None = None
+_ready: Callable[[], bool] = lambda: True
+
+
+# ── Update Instrumentation ───────────────────────────────────────────────────
+
+
+def update_type(update: object) -> str:
+    """Kind of Telegram update (message, callback_query, ...) for metric labels."""
+    if isinstance(update, Update):
+        for kind in Update.ALL_TYPES:
+            if getattr(update, kind, None) is not None:
+                return kind
+    return "other"
+
+
+def update_owner(update: object) -> int | None:
+    """User an update belongs to (the chat for updates without a user), or None if it has neither."""
+    if isinstance(update, Update):
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+    return None
+
+
+class InstrumentedUpdateProcessor(SimpleUpdateProcessor):
+    """SimpleUpdateProcessor that runs updates concurrently, one at a time per user, and counts and times each.
+
+    Updates of different users run in parallel, up to max_concurrent_updates
+    handlers at once; a user's own updates run in arrival order, so the
+    ConversationHandler state and user_data see them one by one, as with
+    sequential processing. max_pending bounds the updates accepted but not yet
+    running: an update waiting behind its user's earlier one does not take a
+    handler slot, so one user flooding the bot can't starve everybody else.
+    """
+
+    __slots__ = ("_running", "_users", "_pending", "_active")
+
+    def __init__(self, max_concurrent_updates: int, max_pending: int = MAX_PENDING_UPDATES):
+        # The base semaphore admits pending updates; _running caps the handlers actually running
+        super().__init__(max(max_pending, max_concurrent_updates))
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._users: dict[int, list] = {}  # user → [lock, holders and waiters]
+        self._pending = 0  # updates accepted and not finished
+        self._active = 0
+
+    @property
+    def active(self) -> int:
+        """Updates whose handlers are running right now."""
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        """Updates accepted but waiting for their user's earlier update or for a free slot."""
+        return self._pending - self._active
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        owner = update_owner(update)
+        self._pending += 1
+        try:
+            if owner is None:
+                await self._run(update, coroutine)
+                return
+
+            # Updates reach this point in arrival order, and asyncio.Lock wakes waiters first-in first-out
+            async with self.user_lock(owner):
+                await self._run(update, coroutine)
+        finally:
+            self._pending -= 1
+
+    @asynccontextmanager
+    async def user_lock(self, owner: int) -> AsyncIterator[None]:
+        """Hold a user's update lock: none of their updates is handled meanwhile.
+
+        For code outside update handling (e.g. a generation job) that changes
+        the user's user_data or conversation UI state.
+        """
+        entry = self._users.setdefault(owner, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._users[owner]
+
+    async def _run(self, update: object, coroutine: Awaitable[Any]) -> None:
+        kind = update_type(update)
+        async with self._running:
+            self._active += 1
+            start = time.perf_counter()
+            try:
+                await coroutine
+            finally:
+                self._active -= 1
+                metrics.inc("photobot_updates_total", type=kind)
+                metrics.observe("photobot_update_seconds", time.perf_counter() - start, type=kind)
+
+
+# ── Event Loop Lag ───────────────────────────────────────────────────────────
+
+
+async def _probe_loop_lag() -> None:
+    """Sleep LOOP_LAG_INTERVAL at a time and record how late each wake-up was."""
+    global _last_probe, _last_lag
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        _last_lag = max(0.0, loop.time() - start - LOOP_LAG_INTERVAL)
+        _last_probe = time.monotonic()
+        metrics.observe("photobot_event_loop_lag_seconds", _last_lag)
+
+
+def is_alive() -> bool:
+    """Liveness: the lag probe ran recently and the loop isn't badly behind."""
+    return time.monotonic() - _last_probe < LIVENESS_MAX_LAG and _last_lag < LIVENESS_MAX_LAG
+
+
+# ── HTTP Endpoint ────────────────────────────────────────────────────────────
+
+
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass  # headers are not needed
+
+        parts = request_line.decode("latin-1").split()
+        path = parts[1].split("?", 1)[0] if len(parts) >= 2 else ""
+
+        if path == "/metrics":
+            status, body, content_type = 200, metrics.render(), "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/healthz":
+            alive = is_alive()
+            status, body = (200, "ok\n") if alive else (503, "event loop stalled\n")
+            content_type = "text/plain"
+        elif path == "/readyz":
+            try:
+                ready = _ready()
+            except Exception as e:
+                logger.warning(f"Readiness check failed: {e}")
+                ready = False
+            status, body = (200, "ready\n") if ready else (503, "not ready\n")
+            content_type = "text/plain"
+        else:
+            status, body, content_type = 404, "not found\n", "text/plain"
+
+        payload = body.encode("utf-8")
+        reason = {200: "OK", 404: "Not Found", 503: "Service Unavailable"}[status]
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode("latin-1") + payload
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start(port: int | None, ready: Callable[[], bool] | None = None) -> None:
+    """Start the loop-lag probe and, if port is set, the HTTP endpoint.
+
+    Must be called from inside the running event loop (e.g. post_init).
+    ready() backs /readyz; /healthz only needs the loop to be responsive.
+    """
+    global _lag_task, _server, _ready, _last_probe
+    _last_probe = time.monotonic()
+    _lag_task = asyncio.create_task(_probe_loop_lag(), name="loop-lag-probe")
+    if ready is not None:
+        _ready = ready
+    if port:
+        _server = await asyncio.start_server(_handle_request, host="0.0.0.0", port=port)
+        logger.info(f"Metrics endpoint listening on :{port} (/metrics, /healthz, /readyz)")
@@ -11,6 +11,8 @@ from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.error import TelegramError
 
 import database as db
+import metrics
+import ratelimit
 
 logger = logging.getLogger(__name__)
 
@@ -19,7 +21,11 @@ _bot_instance = None
 
 
 def init_notifications(bot: Bot):
-    """Initialize notification system with bot instance."""
+    """Initialize notification system with bot instance.
+
+    bot must be an ExtBot (as Application.bot is): sends are marked as bulk
+    for its rate limiter, so interactive replies go first.
+    """
     global _bot_instance
     _bot_instance = bot
     logger.info("Notification system initialized")
@@ -69,9 +75,12 @@ async def send_notification(
             chat_id=user_id,
             text=message,
             reply_markup=reply_markup,
-            parse_mode='HTML'
+            parse_mode='HTML',
+            rate_limit_args=ratelimit.BULK_ARGS,
         )
 
+        metrics.inc("photobot_notifications_total", status="sent")
+
         # Log notification
         _log_notification(user_id, notification_id)
 
@@ -79,6 +88,7 @@ async def send_notification(
         return True
 
     except TelegramError as e:
+        metrics.inc("photobot_notifications_total", status="failed")
         logger.error(f"Failed to send notification {notification_id} to {user_id}: {e}")
         return False
 
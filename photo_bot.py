@@ -6,18 +6,19 @@ Features: credit system, promo codes, referrals, package purchases via YooMoney.
 """
 
 import os
-import io
 import re
+import hashlib
+import time
+import asyncio
 import json
 import logging
 import warnings
 import yaml
 from datetime import datetime, timedelta, timezone
+from functools import partial
 
 from dotenv import load_dotenv
-from PIL import Image
 from google import genai
-from google.genai import types
 from telegram import (
     Update,
     InlineKeyboardButton,
@@ -37,21 +38,81 @@ from telegram.ext import (
     ContextTypes,
 )
 
+import assets
 import database as db
+import effect_health as health
+import generation as gen
+import images
+import metrics
+import monitoring
 import notifications as notif
+import ratelimit
+import scheduler as sched
 
 # ── Configuration ──────────────────────────────────────────────────────────────
 
 load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
 
 TELEGRAM_BOT_TOKEN = os.environ["TELEGRAM_BOT_TOKEN"]
-GEMINI_API_KEY = os.environ["GEMINI_API_KEY"]
+# One or more Gemini keys; GEMINI_API_KEYS (comma-separated) takes precedence
+GEMINI_API_KEYS = gen.parse_api_keys(os.environ.get("GEMINI_API_KEYS") or os.environ["GEMINI_API_KEY"])
 YOOMONEY_PROVIDER_TOKEN = os.environ.get("YOOMONEY_PROVIDER_TOKEN", "")
 ADMIN_ID = int(os.environ.get("ADMIN_ID", 0))
 BOT_USERNAME = os.environ.get("BOT_USERNAME", "your_bot")
 SUPPORT_USERNAME = os.environ.get("SUPPORT_USERNAME", "")  # Support account for "О проекте"
 
-GEMINI_MODEL = "gemini-3-pro-image-preview"
+# Default model route; effects can override with model / fallback_models in effects.yaml
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", gen.DEFAULT_MODEL)
+GEMINI_FALLBACK_MODELS = [
+    m.strip() for m in os.environ.get("GEMINI_FALLBACK_MODELS", ",".join(gen.DEFAULT_FALLBACK_MODELS)).split(",")
+    if m.strip()
+]
+# Switch to a fallback when the model's rolling p95 (seconds) or error rate exceeds these
+GEMINI_ROUTE_P95 = float(os.environ.get("GEMINI_ROUTE_P95", gen.DEFAULT_ROUTE_P95))
+GEMINI_ROUTE_ERROR_RATE = float(os.environ.get("GEMINI_ROUTE_ERROR_RATE", gen.DEFAULT_ROUTE_ERROR_RATE))
+# Long-side cap for input photos sent to Gemini; effects can override with max_input_side
+INPUT_MAX_SIDE = int(os.environ.get("INPUT_MAX_SIDE", images.DEFAULT_MAX_INPUT_SIDE))
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "original").lower()  # original, jpeg or png
+OUTPUT_QUALITY = int(os.environ.get("OUTPUT_QUALITY", 90))  # JPEG quality when transcoding
+# Bounds for the adaptive (AIMD) cap on simultaneous Gemini requests
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", 8))
+GEMINI_MIN_CONCURRENCY = int(os.environ.get("GEMINI_MIN_CONCURRENCY", 1))
+# Per-key request quota (requests per minute) used for routing between keys (unset = no client-side quota)
+GEMINI_KEY_RPM = float(os.environ["GEMINI_KEY_RPM"]) if os.environ.get("GEMINI_KEY_RPM") else gen.DEFAULT_KEY_RPM
+# Stream Gemini responses so refusals end the call early
+GEMINI_STREAM = os.environ.get("GEMINI_STREAM", "1").lower() not in ("0", "false", "no")
+# Per-call deadline and in-call retries on 5xx/429/connection errors
+GEMINI_TIMEOUT = float(os.environ.get("GEMINI_TIMEOUT", gen.DEFAULT_TIMEOUT))
+GEMINI_MAX_RETRIES = int(os.environ.get("GEMINI_MAX_RETRIES", gen.DEFAULT_MAX_RETRIES))
+# Generation worker pool size (global in-flight limit; one active job per user)
+GENERATION_WORKERS = int(os.environ.get("GENERATION_WORKERS", GEMINI_MAX_CONCURRENCY))
+# Durable job retries on transient Gemini errors (5xx, 429, timeouts): attempts and base delay
+GENERATION_MAX_ATTEMPTS = int(os.environ.get("GENERATION_MAX_ATTEMPTS", 3))
+GENERATION_RETRY_DELAY = int(os.environ.get("GENERATION_RETRY_DELAY", 30))  # seconds, doubles per attempt
+# Effect health: hide an effect whose prompt keeps getting blocked / returning no image
+EFFECT_HEALTH_FAILURE_RATE = float(os.environ.get("EFFECT_HEALTH_FAILURE_RATE", health.DEFAULT_FAILURE_RATE))
+EFFECT_HEALTH_MIN_SAMPLES = int(os.environ.get("EFFECT_HEALTH_MIN_SAMPLES", health.DEFAULT_MIN_SAMPLES))
+EFFECT_HEALTH_COOLDOWN = float(os.environ.get("EFFECT_HEALTH_COOLDOWN", health.DEFAULT_COOLDOWN))  # seconds
+# Most variants a user can order from one photo (generated in parallel, one credit each; 1 = off)
+MAX_VARIANTS = max(1, min(10, int(os.environ.get("MAX_VARIANTS", 4))))
+# Seconds a photo stays claimed for its effect, so a double-sent copy is not charged twice
+DUPLICATE_WINDOW = float(os.environ.get("DUPLICATE_WINDOW", 120))
+# Refuse new generations while the estimated wait for one exceeds this many seconds (0 = never)
+MAX_QUEUE_ETA = float(os.environ.get("MAX_QUEUE_ETA", 900))
+# Seconds between sweeps that release expired credit holds no job claims
+HOLD_SWEEP_INTERVAL = float(os.environ.get("HOLD_SWEEP_INTERVAL", 300))
+# Seconds between elapsed-time edits of a running job's status message
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", 5))
+# Chat that gets every logo/category/example image uploaded (and deleted) at startup,
+# so their file_ids are stored before users browse (unset = upload on first use)
+ASSET_WARMUP_CHAT_ID = int(os.environ.get("ASSET_WARMUP_CHAT_ID", 0)) or None
+# Outbound Bot API caps shared by every send path (messages/s overall, and per private chat)
+TELEGRAM_OVERALL_RATE = float(os.environ.get("TELEGRAM_OVERALL_RATE", ratelimit.DEFAULT_OVERALL_RATE))
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", ratelimit.DEFAULT_CHAT_RATE))
+# Telegram updates handled at once (different users in parallel, each user's updates in order)
+UPDATE_CONCURRENCY = max(1, int(os.environ.get("UPDATE_CONCURRENCY", 16)))
+# Port for the /metrics, /healthz and /readyz HTTP endpoint (unset = disabled)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0)) or None
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -71,6 +132,13 @@ for _ext in ("jpg", "png", "webp"):
         break
 
 
+# Delivery copies of category/example images and category preview collages
+# (derived from images/, rebuilt when a source changes)
+DERIVATIVE_DIR = os.path.join(BASE_DIR, images.DERIVATIVE_SUBDIR)
+COLLAGE_DIR = os.path.join(BASE_DIR, ".cache", "collages")
+COLLAGE_MAX_TILES = 9
+
+
 def load_yaml_config() -> tuple[dict, dict]:
     """Load effects and categories from effects.yaml.
 
@@ -113,6 +181,12 @@ def load_yaml_config() -> tuple[dict, dict]:
                 else:
                     logger.error(f"Prompt file not found, skipping effect: {prompt_path}")
                     continue
+            # Generation profile (image_size, aspect_ratio, image_only, safety)
+            try:
+                gen.validate_profile(gen.effect_profile(effect))
+            except ValueError as e:
+                logger.error(f"Invalid generation profile, skipping effect {effect_id}: {e}")
+                continue
             # Auto-resolve example image from images/{effect_id}.jpg
             if "example_image" not in effect:
                 for ext in ("jpg", "png", "webp"):
@@ -126,6 +200,84 @@ def load_yaml_config() -> tuple[dict, dict]:
     return categories, effects
 
 
+def asset_paths() -> list[str]:
+    """Local images the bot sends: the logo, then enabled categories' and effects' images."""
+    paths = [LOGO_PATH]
+    for cat in CATEGORIES.values():
+        paths += [cat.get("collage_image"), cat.get("image")]
+    paths += [effect.get("example_image") for effect in TRANSFORMATIONS.values()]
+    return [path for path in paths if path and os.path.exists(path)]
+
+
+def build_asset_derivatives() -> int:
+    """Point category and example images at their size-capped derivatives, building missing ones.
+
+    The originals stay in cat["image_source"] / effect["example_source"].
+    Blocking (PIL); run it off the event loop. Returns the number of images.
+    """
+    items = [(cat, "image", "image_source") for cat in CATEGORIES.values()]
+    items += [(effect, "example_image", "example_source") for effect in TRANSFORMATIONS.values()]
+    for item, key, source_key in items:
+        item.setdefault(source_key, item.get(key))
+    sources = [
+        item[source_key] for item, _, source_key in items
+        if item[source_key] and os.path.exists(item[source_key])
+    ]
+
+    derivatives = images.build_derivatives(sources, DERIVATIVE_DIR, prune=True)
+    for item, key, source_key in items:
+        if item[source_key] in derivatives:
+            item[key] = derivatives[item[source_key]]
+    return len(derivatives)
+
+
+def build_category_collages() -> int:
+    """Give each category a collage of its effects' example images (cat["collage_image"]).
+
+    A collage is cached in COLLAGE_DIR under a name derived from its effect ids
+    and their images' content hashes, so it is only rebuilt when the effect set
+    or an image changes. Blocking (PIL); run it off the event loop.
+    Returns the number of collages built.
+    """
+    os.makedirs(COLLAGE_DIR, exist_ok=True)
+    built = 0
+    for cat_id, cat in CATEGORIES.items():
+        if not cat.get("collage", True):
+            continue
+        examples = [
+            (effect_id, effect["example_image"])
+            for effect_id, effect in get_effects_for(cat_id).items()
+            if effect.get("example_image") and os.path.exists(effect["example_image"])
+        ][:COLLAGE_MAX_TILES]
+        if len(examples) < 2:
+            continue
+
+        fingerprint = "\n".join(f"{effect_id}:{assets.content_hash(path)}" for effect_id, path in examples)
+        digest = hashlib.sha256(fingerprint.encode()).hexdigest()[:16]
+        collage_path = os.path.join(COLLAGE_DIR, f"{cat_id}-{digest}.jpg")
+        if not os.path.exists(collage_path):
+            data = images.compose_collage([path for _, path in examples])
+            with open(collage_path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(collage_path + ".tmp", collage_path)
+            built += 1
+            # Drop the category's outdated collages
+            for name in os.listdir(COLLAGE_DIR):
+                if name.startswith(f"{cat_id}-") and name != os.path.basename(collage_path):
+                    os.remove(os.path.join(COLLAGE_DIR, name))
+        cat["collage_image"] = collage_path
+    return built
+
+
+def category_image(category_id: str | None) -> str | None:
+    """Anchor image of a category screen: its collage, else its own image."""
+    cat = CATEGORIES.get(category_id or "", {})
+    for path in (cat.get("collage_image"), cat.get("image")):
+        if path and os.path.exists(path):
+            return path
+    return None
+
+
 def get_subcategories(parent_id: str | None) -> dict:
     """Get child categories of a parent (None = top-level)."""
     return {
@@ -182,7 +334,18 @@ PROMO_AMOUNTS = [10, 25, 50, 100]
 
 # ── Gemini client ────────────────────────────────────────────────────────────
 
-gemini_client = genai.Client(api_key=GEMINI_API_KEY)
+gemini_clients = [(gen.key_name(key), genai.Client(api_key=key)) for key in GEMINI_API_KEYS]
+gen.init_generation(
+    gemini_clients,
+    max_concurrency=GEMINI_MAX_CONCURRENCY,
+    timeout=GEMINI_TIMEOUT,
+    max_retries=GEMINI_MAX_RETRIES,
+    min_concurrency=GEMINI_MIN_CONCURRENCY,
+    key_rpm=GEMINI_KEY_RPM,
+    route_p95=GEMINI_ROUTE_P95,
+    route_error_rate=GEMINI_ROUTE_ERROR_RATE,
+    stream=GEMINI_STREAM,
+)
 
 # ── Helper functions ─────────────────────────────────────────────────────────
 
@@ -224,6 +387,14 @@ def back_to_browse_keyboard() -> InlineKeyboardMarkup:
     ])
 
 
+def fewer_variants_keyboard(available: int) -> InlineKeyboardMarkup:
+    """Variant counts the balance still covers, offered when it falls short of the count picked."""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(str(n), callback_data=f"variants_{n}") for n in range(1, min(available, MAX_VARIANTS) + 1)],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_browse")],
+    ])
+
+
 async def edit_message(query, text: str, reply_markup, parse_mode=None):
     """Edit message in place, preserving photo if present (for photo-bearing screens like main menu)."""
     try:
@@ -296,20 +467,18 @@ async def edit_main_menu_screen(query, context, chat_id: int, text: str, reply_m
     try:
         if LOGO_PATH:
             if query.message.photo:
-                with open(LOGO_PATH, "rb") as img:
-                    await query.edit_message_media(
-                        media=InputMediaPhoto(media=img, caption=text),
-                        reply_markup=reply_markup,
-                    )
+                await assets.send(LOGO_PATH, lambda media: query.edit_message_media(
+                    media=InputMediaPhoto(media=media, caption=text),
+                    reply_markup=reply_markup,
+                ))
             else:
                 await query.message.delete()
-                with open(LOGO_PATH, "rb") as img:
-                    await context.bot.send_photo(
-                        chat_id=chat_id,
-                        photo=img,
-                        caption=text,
-                        reply_markup=reply_markup,
-                    )
+                await assets.send(LOGO_PATH, lambda media: context.bot.send_photo(
+                    chat_id=chat_id,
+                    photo=media,
+                    caption=text,
+                    reply_markup=reply_markup,
+                ))
         else:
             if query.message.photo:
                 await query.edit_message_caption(caption=text, reply_markup=reply_markup)
@@ -339,14 +508,13 @@ async def render_create_screen(
     """
     async def _send_new() -> None:
         if image_path and os.path.exists(image_path):
-            with open(image_path, "rb") as img:
-                msg = await context.bot.send_photo(
-                    chat_id=chat_id,
-                    photo=img,
-                    caption=text,
-                    reply_markup=reply_markup,
-                    parse_mode=parse_mode,
-                )
+            msg = await assets.send(image_path, lambda media: context.bot.send_photo(
+                chat_id=chat_id,
+                photo=media,
+                caption=text,
+                reply_markup=reply_markup,
+                parse_mode=parse_mode,
+            ))
             context.user_data["create_ui_message_id"] = msg.message_id
             context.user_data["create_ui_is_photo"] = True
         else:
@@ -369,13 +537,12 @@ async def render_create_screen(
     try:
         if image_path and os.path.exists(image_path):
             if is_photo:
-                with open(image_path, "rb") as img:
-                    await context.bot.edit_message_media(
-                        chat_id=chat_id,
-                        message_id=message_id,
-                        media=InputMediaPhoto(media=img, caption=text, parse_mode=parse_mode),
-                        reply_markup=reply_markup,
-                    )
+                await assets.send(image_path, lambda media: context.bot.edit_message_media(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    media=InputMediaPhoto(media=media, caption=text, parse_mode=parse_mode),
+                    reply_markup=reply_markup,
+                ))
             else:
                 # Text anchor → delete and resend as photo
                 try:
@@ -410,21 +577,39 @@ async def render_create_screen(
         await _send_new()
 
 
+_background_tasks: set[asyncio.Task] = set()  # strong references until each task finishes
+
+
+def start_background(coro, name: str) -> asyncio.Task:
+    """Run coro as a background task, keeping a reference to it and logging it if it fails."""
+    task = asyncio.create_task(coro, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+
+def _background_done(task: asyncio.Task) -> None:
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background task {task.get_name()} failed", exc_info=task.exception())
+
+
 # ── Main Menu ────────────────────────────────────────────────────────────────
 
 
 async def send_main_menu(bot, chat_id, text, reply_markup):
     """Send main menu with logo if available, otherwise text-only."""
     if LOGO_PATH:
-        with open(LOGO_PATH, "rb") as img:
-            await bot.send_photo(chat_id=chat_id, photo=img, caption=text, reply_markup=reply_markup)
+        await assets.send(LOGO_PATH, lambda media: bot.send_photo(
+            chat_id=chat_id, photo=media, caption=text, reply_markup=reply_markup
+        ))
     else:
         await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle /start command. Check for referral link or deep link."""
-    context.user_data.pop("lucky_photo", None)
+    drop_lucky_photo(context.user_data)
     user = update.effective_user
     args = context.args
 
@@ -460,7 +645,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     db.update_last_active(user.id)
 
-    credits = db_user["credits"]
+    credits = db.get_balance(user.id)
     name = user.first_name or "друг"
 
     # If auto_browse is set, go straight to effects menu (single message)
@@ -483,11 +668,10 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     """Show main menu (from callback) using reply keyboard mode."""
     query = update.callback_query
     await query.answer()
-    context.user_data.pop("lucky_photo", None)
+    drop_lucky_photo(context.user_data)
 
     user = update.effective_user
-    db_user = db.get_user(user.id)
-    credits = db_user["credits"] if db_user else 0
+    credits = db.get_balance(user.id)
     name = user.first_name or "друг"
 
     text = f"Привет, {name}!\n⚡ Доступно зарядов: {credits}\nВыбери действие 👇"
@@ -511,11 +695,11 @@ async def restart_bot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     await query.answer()
 
     user = update.effective_user
-    db_user = db.get_user(user.id)
-    credits = db_user["credits"] if db_user else 0
+    credits = db.get_balance(user.id)
     name = user.first_name or "друг"
 
     # Clear any stale user data
+    drop_lucky_photo(context.user_data)
     context.user_data.clear()
 
     text = f"Привет, {name}!\n⚡ Доступно зарядов: {credits}\nВыбери действие 👇"
@@ -535,19 +719,17 @@ async def back_to_browse(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     """Return to previous browse category."""
     query = update.callback_query
     await query.answer()
-    context.user_data.pop("lucky_photo", None)
+    drop_lucky_photo(context.user_data)
 
     user = update.effective_user
-    db_user = db.get_user(user.id)
-    credits = db_user["credits"] if db_user else 0
+    credits = db.get_balance(user.id)
 
     category_id = context.user_data.get("previous_category")
     context.user_data["current_category"] = category_id
 
     title, keyboard = build_browse_keyboard(category_id, credits)
 
-    cat_image = CATEGORIES.get(category_id or "", {}).get("image") if category_id else None
-    image_path = (cat_image if cat_image and os.path.exists(cat_image) else None) or LOGO_PATH
+    image_path = category_image(category_id) or LOGO_PATH
 
     await render_create_screen(context, user.id, title, keyboard, image_path)
     return BROWSING
@@ -564,8 +746,10 @@ def build_browse_keyboard(category_id: str | None, credits: int) -> tuple[str, I
     """
     buttons = []
 
-    # Effects at this level
+    # Effects at this level (auto-disabled effects are hidden until their cooldown probe)
     for eff_id, eff in get_effects_for(category_id).items():
+        if not health.is_available(eff_id):
+            continue
         buttons.append([InlineKeyboardButton(eff["label"], callback_data=f"effect_{eff_id}")])
 
     # Subcategories
@@ -587,14 +771,13 @@ def build_browse_keyboard(category_id: str | None, credits: int) -> tuple[str, I
 async def handle_reply_create(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle '✨ Создать магию' from reply keyboard."""
     user = update.effective_user
-    db_user = db.get_user(user.id)
-    credits = db_user["credits"] if db_user else 0
+    credits = db.get_balance(user.id)
 
     context.user_data['current_category'] = None
     # Clear stale anchor so render_create_screen sends a fresh message
     context.user_data.pop("create_ui_message_id", None)
     context.user_data.pop("create_ui_is_photo", None)
-    context.user_data.pop("lucky_photo", None)
+    drop_lucky_photo(context.user_data)
 
     title, keyboard = build_browse_keyboard(None, credits)
     await render_create_screen(context, update.effective_chat.id, title, keyboard, LOGO_PATH)
@@ -603,7 +786,7 @@ async def handle_reply_create(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def handle_reply_store(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle '💳 Пополнить запасы' from reply keyboard."""
-    context.user_data.pop("lucky_photo", None)
+    drop_lucky_photo(context.user_data)
     buttons = [
         [InlineKeyboardButton(pkg["label"], callback_data=f"buy_{key}")]
         for key, pkg in PACKAGES.items()
@@ -615,7 +798,7 @@ async def handle_reply_store(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def handle_reply_promo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle '🎁 Промокод' from reply keyboard."""
-    context.user_data.pop("lucky_photo", None)
+    drop_lucky_photo(context.user_data)
     await update.message.reply_text(
         "Введи промокод:",
         reply_markup=InlineKeyboardMarkup([
@@ -627,7 +810,7 @@ async def handle_reply_promo(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def handle_reply_referral(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle '👥 Пригласить друга' from reply keyboard."""
-    context.user_data.pop("lucky_photo", None)
+    drop_lucky_photo(context.user_data)
     user = update.effective_user
     ref_link = f"https://t.me/{BOT_USERNAME}?start=ref_{user.id}"
     await update.message.reply_text(
@@ -646,10 +829,9 @@ async def show_browse_root(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     """Show top-level browse screen (from inline menu)."""
     query = update.callback_query
     await query.answer()
-    context.user_data.pop("lucky_photo", None)
+    drop_lucky_photo(context.user_data)
     user = update.effective_user
-    db_user = db.get_user(user.id)
-    credits = db_user["credits"] if db_user else 0
+    credits = db.get_balance(user.id)
 
     context.user_data['current_category'] = None
     # Adopt the current callback message as Create anchor when available.
@@ -666,10 +848,9 @@ async def browse_category(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     """Navigate into a category/subcategory — generic handler for any depth."""
     query = update.callback_query
     await query.answer()
-    context.user_data.pop("lucky_photo", None)
+    drop_lucky_photo(context.user_data)
     user = update.effective_user
-    db_user = db.get_user(user.id)
-    credits = db_user["credits"] if db_user else 0
+    credits = db.get_balance(user.id)
 
     category_id = query.data.removeprefix("cat_")
 
@@ -686,10 +867,7 @@ async def browse_category(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     title, keyboard = build_browse_keyboard(category_id, credits)
 
-    cat_image = CATEGORIES.get(category_id, {}).get("image")
-    image_path = cat_image if cat_image and os.path.exists(cat_image) else None
-
-    await render_create_screen(context, update.effective_chat.id, title, keyboard, image_path)
+    await render_create_screen(context, update.effective_chat.id, title, keyboard, category_image(category_id))
     return BROWSING
 
 
@@ -697,16 +875,23 @@ async def select_effect(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     """User selected an effect. Check credits and show description."""
     query = update.callback_query
     await query.answer()
-    context.user_data.pop("lucky_photo", None)
+    drop_lucky_photo(context.user_data)
 
     effect_id = query.data.replace("effect_", "")
     if effect_id not in TRANSFORMATIONS:
         await query.edit_message_text("Неизвестный эффект.", reply_markup=back_to_main_keyboard())
         return MAIN_MENU
+    if not health.is_available(effect_id):
+        await render_create_screen(
+            context,
+            update.effective_chat.id,
+            "⚠️ Этот эффект временно недоступен — попробуй другой",
+            back_to_browse_keyboard(),
+        )
+        return BROWSING
 
     user = update.effective_user
-    db_user = db.get_user(user.id)
-    credits = db_user["credits"] if db_user else 0
+    credits = db.get_balance(user.id)
 
     # Check credits
     if credits < 1:
@@ -733,18 +918,33 @@ async def select_effect(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         )
         return BROWSING
 
-    # Store selected effect and remember which category we came from
+    # Store selected effect and remember which category we came from; each effect starts at one variant
     context.user_data["effect_id"] = effect_id
     context.user_data["previous_category"] = context.user_data.get('current_category')
+    context.user_data["variants"] = 1
+
+    await render_effect_screen(context, update.effective_chat.id, effect_id, credits)
+    return WAITING_PHOTO
 
+
+async def render_effect_screen(context, chat_id: int, effect_id: str, credits: int) -> None:
+    """Effect description + photo request, with a variant-count picker when the user can afford more than one."""
     effect = TRANSFORMATIONS[effect_id]
+    affordable = min(MAX_VARIANTS, credits)
+    variants = min(context.user_data.get("variants", 1), max(1, affordable))
+    context.user_data["variants"] = variants
 
     # Build back button that returns to the category we came from
     previous_category = context.user_data.get("previous_category")
     back_callback = f"cat_{previous_category}" if previous_category else "browse_root"
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("⬅️ Назад", callback_data=back_callback)],
-    ])
+    buttons = []
+    if affordable > 1:
+        buttons.append([
+            InlineKeyboardButton(f"✅ {n}" if n == variants else str(n), callback_data=f"variants_{n}")
+            for n in range(1, affordable + 1)
+        ])
+    buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data=back_callback)])
+    keyboard = InlineKeyboardMarkup(buttons)
 
     tips = (effect.get('tips') or '').strip()
     best_input = (effect.get('best_input') or '').strip()
@@ -753,19 +953,63 @@ async def select_effect(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         parts.append(tips)
     if best_input:
         parts.append(f"📷 Лучше всего подойдёт: {best_input}")
+    if affordable > 1:
+        parts.append(
+            f"🎲 Вариантов из одного фото: {variants} (спишется зарядов: {variants})\n"
+            "Все варианты создаются одновременно"
+        )
     parts.append("Отправь мне фото для обработки 👇")
     message = "\n\n".join(parts)
 
     example_image = effect.get("example_image")
     image_path = example_image if example_image and os.path.exists(example_image) else None
-    await render_create_screen(context, update.effective_chat.id, message, keyboard, image_path)
+    await render_create_screen(context, chat_id, message, keyboard, image_path)
+
+
+async def select_variants(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """User picked how many variants to generate from the next photo."""
+    query = update.callback_query
+    await query.answer()
+
+    effect_id = context.user_data.get("effect_id")
+    if not effect_id or effect_id not in TRANSFORMATIONS:
+        await query.edit_message_text("Неизвестный эффект.", reply_markup=back_to_main_keyboard())
+        return MAIN_MENU
+
+    variants = max(1, min(MAX_VARIANTS, int(query.data.replace("variants_", ""))))
+    context.user_data["variants"] = variants
+    if query.message and query.message.message_id != context.user_data.get("create_ui_message_id"):
+        # Picked from the not-enough-credits offer under a photo: the photo has to come again
+        await query.edit_message_text(f"🎲 Вариантов: {variants}. Отправь фото ещё раз 👇")
+        return WAITING_PHOTO
+    credits = db.get_balance(update.effective_user.id)
+    await render_effect_screen(context, update.effective_chat.id, effect_id, credits)
     return WAITING_PHOTO
 
 
-async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Receive photo and process it."""
+async def select_lucky_variants(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """User picked fewer variants after their prompt fell short of credits; the photo is still kept."""
+    query = update.callback_query
+    await query.answer()
+    variants = max(1, min(MAX_VARIANTS, int(query.data.replace("variants_", ""))))
+    context.user_data["variants"] = variants
+    await query.edit_message_text(f"🎲 Вариантов: {variants}. Отправь запрос ещё раз ✏️")
+    return WAITING_LUCKY_PROMPT
+
+
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int | None:
+    """Receive photo and queue it for generation."""
     effect_id = context.user_data.get("effect_id")
+
+    # Double-sent photos and the rest of an album are dropped before any DB write
+    submission = claim_submission(update.effective_user.id, update.message, effect_id)
+    if submission is None:
+        if not update.message.media_group_id:
+            await update.message.reply_text("⏳ Это фото уже в работе — результат придёт сюда")
+        return None
+
     if not effect_id or effect_id not in TRANSFORMATIONS:
+        release_submission(submission)
         # Session lost - offer restart
         await update.message.reply_text(
             "❌ Сессия истекла\n\nНажми кнопку ниже, чтобы начать заново:",
@@ -775,10 +1019,40 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         )
         return MAIN_MENU
 
+    if not health.is_available(effect_id):
+        release_submission(submission)
+        await update.message.reply_text(
+            "⚠️ Этот эффект временно недоступен — попробуй другой",
+            reply_markup=back_to_browse_keyboard(),
+        )
+        return BROWSING
+
     user = update.effective_user
+    eta = sched.eta({"user_id": user.id, "effect_id": effect_id})
+    if MAX_QUEUE_ETA and eta > MAX_QUEUE_ETA:
+        release_submission(submission)
+        await update.message.reply_text(queue_full_text(eta), reply_markup=back_to_browse_keyboard())
+        return WAITING_PHOTO
+
+    variants = context.user_data.get("variants", 1)
+    effect = TRANSFORMATIONS[effect_id]
 
-    # Deduct credit
-    if not db.deduct_credit(user.id):
+    # Hold credits (one per variant); free_prompt only checks now and holds once the text arrives
+    hold_id = None
+    if effect.get("type") == "free_prompt":
+        enough = db.get_balance(user.id) >= variants
+    else:
+        hold_id = db.reserve_credits(user.id, variants)
+        enough = hold_id is not None
+    if not enough:
+        release_submission(submission)
+        available = db.get_balance(user.id)
+        if variants > 1 and available >= 1:
+            await update.message.reply_text(
+                f"⚡ Зарядов хватит на {available} из {variants} вариантов — выбери, сколько сделать:",
+                reply_markup=fewer_variants_keyboard(available),
+            )
+            return WAITING_PHOTO
         # Credits exhausted message (inline UI)
         message = (
             "😮‍💨 Заряды кончились. Бывает.\n\n"
@@ -801,24 +1075,14 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
         return MAIN_MENU
 
-    # Download photo
-    photo_file = await update.message.photo[-1].get_file()
-    photo_bytes = await photo_file.download_as_bytearray()
-
-    effect = TRANSFORMATIONS[effect_id]
+    # The worker downloads the photo itself when the job starts
+    photo_file_id = update.message.photo[-1].file_id
 
-    # free_prompt branch: store photo, ask for user's text prompt (before spinner + try/finally)
+    # free_prompt branch: remember photo, ask for user's text prompt
     if effect.get("type") == "free_prompt":
-        db.refund_credit(user.id)  # charge later, when user actually submits their text
-        try:
-            buf = io.BytesIO()
-            Image.open(io.BytesIO(bytes(photo_bytes))).save(buf, format="PNG")
-            context.user_data["lucky_photo"] = buf.getvalue()
-        except Exception as e:
-            logger.error("Failed to process photo for free_prompt: %s", e)
-            # Credit already refunded above — do NOT call add_credits again
-            await update.message.reply_text("❌ Не удалось обработать фото. Попробуй ещё раз.")
-            return WAITING_PHOTO
+        drop_lucky_photo(context.user_data)  # an earlier photo still waiting for its prompt
+        context.user_data["lucky_photo"] = photo_file_id
+        context.user_data["lucky_submission"] = submission
 
         previous_category = context.user_data.get("previous_category")
         back_callback = f"cat_{previous_category}" if previous_category else "browse_root"
@@ -844,128 +1108,10 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         context.user_data["create_ui_is_photo"] = False
         return WAITING_LUCKY_PROMPT
 
-    status_msg = await update.message.reply_text("⏳ Создаю магию...")
-
-    try:
-        input_image = Image.open(io.BytesIO(bytes(photo_bytes)))
-
-        # Call Gemini
-        logger.info(f"Calling Gemini model: {GEMINI_MODEL}")
-        response = gemini_client.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=[effect["prompt"], input_image],
-            config=types.GenerateContentConfig(
-                response_modalities=["Text", "Image"],
-            ),
-        )
-        # Log model info from response if available
-        if hasattr(response, 'model_version'):
-            logger.info(f"Gemini response model_version: {response.model_version}")
-        logger.info(f"Gemini response candidates: {len(response.candidates) if response.candidates else 0}")
-
-        # Extract result image
-        result_image = None
-        result_text = None
-        for part in response.parts:
-            if part.inline_data is not None:
-                # Convert Gemini response to PIL Image
-                image_data = part.inline_data.data
-                result_image = Image.open(io.BytesIO(image_data))
-            elif part.text is not None:
-                result_text = part.text
-
-        if result_image is None:
-            # Record failed generation, then refund credit
-            db.record_generation(user.id, effect_id, status="failed")
-            new_balance = db.refund_credit(user.id)
-            msg = f"❌ Что-то пошло не так\n\nКредит возвращён на баланс.\n⚡ Доступно зарядов: {new_balance}"
-            if result_text:
-                msg += f"\n\nОтвет модели: {result_text[:200]}"
-
-            # Build back button that returns to the category we came from
-            previous_category = context.user_data.get("previous_category")
-            back_callback = f"cat_{previous_category}" if previous_category else "browse_root"
-
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔄 Попробовать снова", callback_data=f"effect_{effect_id}")],
-                [InlineKeyboardButton("⬅️ Назад", callback_data=back_callback)],
-            ])
-            await status_msg.edit_text(msg, reply_markup=keyboard)
-            return BROWSING
-
-        # Record generation for statistics
-        db.record_generation(user.id, effect_id)
-        db.update_last_active(user.id)
-
-        # Credit referrer on first generation (only for referrer's first 10 referrals)
-        referrer_id = db.credit_referral_on_generation(user.id)
-        if referrer_id:
-            db.add_credits(referrer_id, 3)
-            logger.info(f"Credited referrer {referrer_id} with 3 credits (generation) for user {user.id}")
-
-        # Get updated balance
-        db_user = db.get_user(user.id)
-        remaining = db_user["credits"] if db_user else 0
-
-        # Real-time notification triggers
-        gen_count = db.get_user_generation_count(user.id)
-
-        # N2: Credits Running Low
-        if remaining == 1:
-            await notif.send_credits_low_warning(user.id)
-
-
-        # Send result with navigation buttons
-        previous_category = context.user_data.get("previous_category")
-        context.user_data["current_category"] = previous_category
-        back_callback = f"cat_{previous_category}" if previous_category else "browse_root"
-        result_keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔄 Попробовать снова", callback_data=f"effect_{effect_id}")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data=back_callback)],
-        ])
-
-        output_buffer = io.BytesIO()
-        result_image.save(output_buffer, format="PNG")
-        output_buffer.seek(0)
-
-        await status_msg.delete()
-        await update.message.reply_photo(
-            photo=output_buffer,
-            caption=f"✅ {effect['label']}\n⚡ Осталось зарядов: {remaining}",
-            reply_markup=result_keyboard,
-        )
-
-        # Delete old anchor (replaced by result photo buttons)
-        old_anchor_id = context.user_data.pop("create_ui_message_id", None)
-        context.user_data.pop("create_ui_is_photo", None)
-        if old_anchor_id:
-            try:
-                await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=old_anchor_id)
-            except Exception:
-                pass
-
-    except Exception as e:
-        logger.error("Error during transformation: %s", e, exc_info=True)
-        # Record failed generation, then refund credit
-        db.record_generation(user.id, effect_id, status="failed")
-        new_balance = db.refund_credit(user.id)
-
-        # Build back button that returns to the category we came from
-        previous_category = context.user_data.get("previous_category")
-        back_callback = f"cat_{previous_category}" if previous_category else "browse_root"
-
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔄 Попробовать снова", callback_data=f"effect_{effect_id}")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data=back_callback)],
-        ])
-        await status_msg.edit_text(
-            f"❌ Что-то пошло не так\n\nКредит возвращён на баланс.\n⚡ Доступно зарядов: {new_balance}\n\nОшибка: {str(e)[:100]}",
-            reply_markup=keyboard,
-        )
-        return BROWSING
-    finally:
-        context.user_data.pop("effect_id", None)
-
+    await enqueue_generation(
+        update, context, effect_id, effect["prompt"], photo_file_id, variants, hold_id, submission
+    )
+    context.user_data.pop("effect_id", None)
     return BROWSING
 
 
@@ -985,11 +1131,12 @@ async def photo_expected(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 async def handle_lucky_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Receive user's text prompt and apply it to the stored photo."""
+    """Receive user's text prompt and queue it with the stored photo."""
     effect_id = context.user_data.get("effect_id")
-    photo_bytes = context.user_data.get("lucky_photo")
+    photo_file_id = context.user_data.get("lucky_photo")
 
-    if not effect_id or not photo_bytes or effect_id not in TRANSFORMATIONS:
+    if not effect_id or not photo_file_id or effect_id not in TRANSFORMATIONS:
+        drop_lucky_photo(context.user_data)
         await update.message.reply_text(
             "❌ Сессия истекла\n\nНажми кнопку ниже, чтобы начать заново:",
             reply_markup=InlineKeyboardMarkup([
@@ -1005,8 +1152,23 @@ async def handle_lucky_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("✏️ Пустой запрос не считается 🙈 Напиши что-нибудь!")
         return WAITING_LUCKY_PROMPT
 
-    if not db.deduct_credit(user.id):
-        context.user_data.pop("lucky_photo", None)
+    eta = sched.eta({"user_id": user.id, "effect_id": effect_id})
+    if MAX_QUEUE_ETA and eta > MAX_QUEUE_ETA:
+        await update.message.reply_text(queue_full_text(eta), reply_markup=back_to_browse_keyboard())
+        return WAITING_LUCKY_PROMPT  # photo and effect kept; the same text can be sent again later
+
+    variants = context.user_data.get("variants", 1)
+    hold_id = db.reserve_credits(user.id, variants)
+    available = db.get_balance(user.id) if hold_id is None else 0
+    if variants > 1 and available >= 1:
+        # Photo and effect kept: a smaller count is picked, then the prompt sent again
+        await update.message.reply_text(
+            f"⚡ Зарядов хватит на {available} из {variants} вариантов — выбери, сколько сделать:",
+            reply_markup=fewer_variants_keyboard(available),
+        )
+        return WAITING_LUCKY_PROMPT
+    if hold_id is None:
+        drop_lucky_photo(context.user_data)
         context.user_data.pop("effect_id", None)
         message = (
             "😮‍💨 Заряды кончились. Бывает.\n\n"
@@ -1022,117 +1184,613 @@ async def handle_lucky_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text(message, reply_markup=keyboard, parse_mode="HTML")
         return MAIN_MENU
 
-    effect = TRANSFORMATIONS[effect_id]
-    status_msg = await update.message.reply_text("⏳ Создаю магию...")
+    await enqueue_generation(
+        update, context, effect_id, user_text, photo_file_id, variants, hold_id,
+        context.user_data.pop("lucky_submission", None),
+    )
+    context.user_data.pop("effect_id", None)
+    context.user_data.pop("lucky_photo", None)  # claim handed to the job above
+    return BROWSING
+
+
+async def lucky_prompt_expected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Handle non-text message when prompt text is expected."""
+    if is_claimed_album(update.effective_user.id, update.message):
+        return WAITING_LUCKY_PROMPT  # rest of the album whose first photo we kept
+    previous_category = context.user_data.get("previous_category")
+    back_callback = f"cat_{previous_category}" if previous_category else "browse_root"
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("⬅️ Назад", callback_data=back_callback)],
+    ])
+    await render_create_screen(
+        context,
+        update.effective_chat.id,
+        "Мне нужен текст, а не это 😄 Напиши словами что сделать с фото",
+        keyboard,
+    )
+    return WAITING_LUCKY_PROMPT
+
+
+# ── Generation Jobs ──────────────────────────────────────────────────────────
 
+
+GENERATION_STAGES = {
+    "download": "📥 Загружаю фото",
+    "generate": "🎨 Нейросеть рисует",
+    "send": "📤 Отправляю результат",
+}
+
+
+def eta_text(seconds: float) -> str:
+    """Rough human wait time: "~40 с", "~3 мин"."""
+    if seconds < 55:
+        return f"~{max(10, round(seconds / 10) * 10)} с"
+    return f"~{max(1, round(seconds / 60))} мин"
+
+
+def generation_status_text(
+    position: int, stage: str | None = None, elapsed: float = 0, eta: float | None = None
+) -> str:
+    """Status message text for a queued or running generation (eta in seconds, shown until it starts)."""
+    if stage:
+        return f"⏳ Создаю магию...\n\n{GENERATION_STAGES[stage]} · {int(elapsed)} с"
+    lines = []
+    if position > 0:
+        lines.append(f"🕐 Твоё место в очереди: {position}")
+    if eta is not None:
+        lines.append(f"⏱ Будет готово через {eta_text(eta)}")
+    return "\n\n".join(["⏳ Создаю магию...", "\n".join(lines)]) if lines else "⏳ Создаю магию..."
+
+
+def queue_full_text(eta: float) -> str:
+    """Refusal shown when the queue is too long to take another generation."""
+    return (
+        "🚦 Сейчас очень много желающих — очередь растянулась на "
+        f"{eta_text(eta)}.\n\nЗаряды не списаны. Попробуй чуть позже!"
+    )
+
+
+def cancel_keyboard(job_id: int) -> InlineKeyboardMarkup:
+    """Cancel button shown under a queued or running generation's status message."""
+    return InlineKeyboardMarkup([[InlineKeyboardButton("✖️ Отменить", callback_data=f"cancel_job_{job_id}")]])
+
+
+def result_keyboard_for(job: dict) -> InlineKeyboardMarkup:
+    """Try-again / back buttons under a finished generation."""
+    previous_category = job["previous_category"]
+    back_callback = f"cat_{previous_category}" if previous_category else "browse_root"
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 Попробовать снова", callback_data=f"effect_{job['effect_id']}")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data=back_callback)],
+    ])
+
+
+class GenerationProgress:
+    """Keeps a running job's status message showing its stage and elapsed time.
+
+    A stage change is shown within a second; otherwise the message is edited
+    every PROGRESS_INTERVAL seconds, well inside Telegram's edit limits.
+    """
+
+    def __init__(self, bot, chat_id: int, message_id: int, reply_markup=None):
+        self._bot = bot
+        self._chat_id = chat_id
+        self._message_id = message_id
+        self.reply_markup = reply_markup  # kept on every edit (e.g. the cancel button); None drops it
+        self._started = time.monotonic()
+        self._last_edit = 0.0
+        self._shown_stage: str | None = None
+        self._task: asyncio.Task | None = None
+        self.stage = "download"
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop editing (call before the status message is replaced or deleted)."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            gap = 1.0 if self.stage != self._shown_stage else PROGRESS_INTERVAL
+            if now - self._last_edit >= gap:
+                self._last_edit = now
+                self._shown_stage = self.stage
+                try:
+                    await self._bot.edit_message_text(
+                        generation_status_text(0, self.stage, now - self._started),
+                        chat_id=self._chat_id,
+                        message_id=self._message_id,
+                        reply_markup=self.reply_markup,
+                    )
+                except Exception as e:
+                    logger.debug(f"Progress update failed for message {self._message_id}: {e}")
+            await asyncio.sleep(1.0)
+
+
+def effect_models(effect: dict) -> list[str]:
+    """Model preference list for an effect: its primary model, then fallbacks."""
+    models = [effect.get("model") or GEMINI_MODEL]
+    for model in effect.get("fallback_models", GEMINI_FALLBACK_MODELS) or []:
+        if model not in models:
+            models.append(model)
+    return models
+
+
+async def generate_variant(model: str, prompt: str, image, config) -> tuple:
+    """One Gemini call for a job variant. Returns (response, seconds)."""
+    start = time.perf_counter()
+    response = await gen.generate_content(model, prompt, image, config)
+    return response, time.perf_counter() - start
+
+
+async def track_effect_health(bot, effect_id: str, status: str, failure_class: str | None = None) -> None:
+    """Feed a generation outcome to the effect health monitor; tell the admin when an effect flips."""
+    effect = TRANSFORMATIONS.get(effect_id)
+    if effect is None or effect.get("type") == "free_prompt":
+        return  # user-written prompts fail for reasons of their own
+    change = health.record(effect_id, status, failure_class)
+    if change is None or not ADMIN_ID:
+        return
+    if change == "disabled":
+        failed, total = health.failure_rate(effect_id)
+        text = (
+            f"🚨 Эффект отключён: {effect['label']} ({effect_id})\n\n"
+            f"Без результата (блок или пустой ответ): {failed} из {total} последних генераций.\n"
+            f"Скрыт из меню; пробная генерация через {EFFECT_HEALTH_COOLDOWN / 60:.0f} мин."
+        )
+    else:
+        text = f"✅ Эффект снова включён: {effect['label']} ({effect_id}) — пробная генерация прошла"
+    try:
+        await bot.send_message(chat_id=ADMIN_ID, text=text)
+    except Exception as e:
+        logger.warning(f"Effect health alert failed: {e}")
+
+
+def generation_error_text(error: Exception) -> str:
+    """User-facing text for a failed generation (raw errors stay in the logs)."""
+    if isinstance(error, gen.CircuitOpenError):
+        return "⚠️ Нейросеть сейчас недоступна, попробуй чуть позже"
+    if isinstance(error, asyncio.TimeoutError):
+        return "⌛ Нейросеть не ответила вовремя"
+    if gen.is_transient_error(error):
+        return "⚠️ Нейросеть сейчас перегружена, попробуй чуть позже"
+    return "❌ Что-то пошло не так"
+
+
+# Photo submissions still in flight: key → (effect_id, claimed_at monotonic).
+# Keys are ("photo", user_id, file_unique_id) and ("album", user_id, media_group_id).
+_submissions: dict[tuple, tuple[str | None, float]] = {}
+
+
+def claim_submission(user_id: int, message, effect_id: str | None) -> list | None:
+    """Claim a photo message for effect_id; None if it repeats a submission still in flight.
+
+    A repeat is the same photo (file_unique_id, so a forward or re-upload of
+    the same file counts) for the same effect within DUPLICATE_WINDOW, or any
+    further photo of an album whose first photo was already taken. Checked in
+    memory before any DB write or Gemini call; the claim is held until the job
+    finishes, or until the window runs out for an abandoned flow.
+    """
+    now = time.monotonic()
+    for key in [k for k, (_, at) in _submissions.items() if now - at >= DUPLICATE_WINDOW]:
+        del _submissions[key]
+
+    photo = ("photo", user_id, message.photo[-1].file_unique_id)
+    # Keyed per effect, so the same photo under two effects holds two independent claims
+    keys = [(*photo, effect_id)]
+    if message.media_group_id:
+        keys.append(("album", user_id, message.media_group_id))
+        if keys[1] in _submissions:
+            return None
+    if effect_id is None:
+        # No effect_id means the session was taken by the original submission, whatever its effect
+        if any(key[:3] == photo for key in _submissions):
+            return None
+    elif keys[0] in _submissions:
+        return None
+
+    for key in keys:
+        _submissions[key] = (effect_id, now)
+    return keys
+
+
+def release_submission(keys: list | None) -> None:
+    """Drop a claim so the same photo can be submitted again."""
+    for key in keys or ():
+        _submissions.pop(key, None)
+
+
+def drop_lucky_photo(user_data: dict) -> None:
+    """Forget a photo waiting for its lucky prompt and release its duplicate claim."""
+    user_data.pop("lucky_photo", None)
+    release_submission(user_data.pop("lucky_submission", None))
+
+
+def is_claimed_album(user_id: int, message) -> bool:
+    """True for a photo from an album whose first photo was already taken."""
+    return bool(message.media_group_id) and ("album", user_id, message.media_group_id) in _submissions
+
+
+async def enqueue_generation(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    effect_id: str,
+    prompt: str,
+    photo_file_id: str,
+    variants: int = 1,
+    hold_id: int | None = None,
+    submission: list | None = None,
+) -> None:
+    """Persist a generation job, post its status message and hand it to the scheduler.
+
+    hold_id is the credit hold (one credit per variant) reserved for the job;
+    it is charged for delivered variants and released for the rest.
+    submission (from claim_submission) stays claimed until the job finishes.
+    """
+    status_msg = await update.message.reply_text(generation_status_text(0))
+
+    # The result photo replaces the current Create anchor once it is delivered.
+    anchor_message_id = context.user_data.pop("create_ui_message_id", None)
+    context.user_data.pop("create_ui_is_photo", None)
+
+    job = dict(db.create_job(
+        telegram_id=update.effective_user.id,
+        chat_id=update.effective_chat.id,
+        effect_id=effect_id,
+        prompt=prompt,
+        photo_file_id=photo_file_id,
+        previous_category=context.user_data.get("previous_category"),
+        status_message_id=status_msg.message_id,
+        anchor_message_id=anchor_message_id,
+        variants=variants,
+        hold_id=hold_id,
+    ))
+    job["submission"] = submission
+    position = sched.submit(job)
     try:
-        input_image = Image.open(io.BytesIO(photo_bytes))
-
-        logger.info(f"Calling Gemini model (free_prompt): {GEMINI_MODEL}")
-        response = gemini_client.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=[user_text, input_image],
-            config=types.GenerateContentConfig(
-                response_modalities=["Text", "Image"],
-            ),
+        await status_msg.edit_text(
+            generation_status_text(position, eta=sched.eta(job)), reply_markup=cancel_keyboard(job["id"])
         )
+    except Exception:
+        pass
+
 
-        result_image = None
+async def on_generation_position(application: Application, job: dict, position: int) -> None:
+    """Scheduler callback: show the job's new queue position in its status message."""
+    await application.bot.edit_message_text(
+        generation_status_text(position, eta=sched.eta(job)),
+        chat_id=job["chat_id"],
+        message_id=job["status_message_id"],
+        reply_markup=cancel_keyboard(job["id"]),
+    )
+
+
+async def run_generation_job(application: Application, job: dict) -> None:
+    """Scheduler runner: download the photo, call Gemini, deliver the result or release the hold.
+
+    Transient Gemini failures put the job back in the queue (up to
+    GENERATION_MAX_ATTEMPTS), keeping its credit hold, instead of failing straight away.
+    """
+    bot = application.bot
+    user_id = job["user_id"]
+    chat_id = job["chat_id"]
+    effect_id = job["effect_id"]
+    # Job may outlive a restart that disabled its effect; the prompt is stored on the job
+    effect = TRANSFORMATIONS.get(effect_id, {"label": "✨ Магия"})
+    variants = job.get("variants") or 1
+    settled = 0  # variants already recorded as failed
+    retrying = False
+    delivered = False  # result sent and hold committed: nothing after this may refund or redo the job
+    model = None
+    telemetry: dict = {}  # per-job telemetry shared by every variant (input_bytes)
+
+    db.mark_job_running(job["id"])
+    job["attempts"] += 1
+    job["settling"] = False  # set once an image has come back; the job can no longer be cancelled
+
+    # Result buttons: try again, or back to the category we came from
+    previous_category = job["previous_category"]
+    result_keyboard = result_keyboard_for(job)
+
+    started = time.perf_counter()
+    if "submitted_at" in job:
+        metrics.record("queue", time.monotonic() - job["submitted_at"], effect_id)
+
+    progress = GenerationProgress(bot, chat_id, job["status_message_id"], cancel_keyboard(job["id"]))
+    progress.start()
+
+    try:
+        with metrics.timer("download", effect_id):
+            photo_file = await bot.get_file(job["photo_file_id"])
+            photo_bytes = bytes(await photo_file.download_as_bytearray())
+
+        # Downscale + fix orientation off the event loop (small photos pass straight through)
+        max_side = effect.get("max_input_side", INPUT_MAX_SIDE)
+        with metrics.timer("preprocess", effect_id):
+            input_bytes, input_mime = await asyncio.to_thread(images.preprocess_input, photo_bytes, max_side)
+        logger.info(f"Input photo: {len(photo_bytes)} → {len(input_bytes)} bytes ({input_mime})")
+
+        # Call Gemini, once per variant, all in parallel
+        progress.stage = "generate"
+        model = gen.route(effect_models(effect))
+        logger.info(f"Calling Gemini model: {model} ({variants} variant(s))")
+        image = gen.image_part(input_bytes, input_mime)
+        config = gen.build_config(gen.effect_profile(effect), model)
+        with metrics.timer("gemini", effect_id):
+            outcomes = await asyncio.gather(
+                *(generate_variant(model, job["prompt"], image, config) for _ in range(variants)),
+                return_exceptions=True,
+            )
+        telemetry["input_bytes"] = len(input_bytes)
+        errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+        if len(errors) == variants:
+            raise errors[0]  # nothing came back: retry or refund the whole job
+
+        # Split into delivered images and failed variants (errors, refusals, empty responses)
+        results = []   # (image bytes, mime type, telemetry)
+        failures = []  # (failure class, telemetry)
+        block_reason = None
         result_text = None
-        for part in response.parts:
-            if part.inline_data is not None:
-                result_image = Image.open(io.BytesIO(part.inline_data.data))
-            elif part.text is not None:
-                result_text = part.text
-
-        if result_image is None:
-            db.record_generation(user.id, effect_id, status="failed")
-            new_balance = db.refund_credit(user.id)
-            previous_category = context.user_data.get("previous_category")
-            back_callback = f"cat_{previous_category}" if previous_category else "browse_root"
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔄 Попробовать снова", callback_data=f"effect_{effect_id}")],
-                [InlineKeyboardButton("⬅️ Назад", callback_data=back_callback)],
-            ])
-            await status_msg.edit_text(
-                f"❌ Что-то пошло не так\n\nКредит возвращён.\n⚡ Доступно зарядов: {new_balance}",
-                reply_markup=keyboard,
+        for outcome in outcomes:
+            if isinstance(outcome, BaseException):
+                logger.warning(f"Variant failed on job {job['id']}: {outcome}")
+                failures.append((gen.failure_class(outcome), telemetry))
+                continue
+            response, seconds = outcome
+            # Log model info from response if available
+            if hasattr(response, 'model_version'):
+                logger.info(f"Gemini response model_version: {response.model_version}")
+            logger.info(f"Gemini response candidates: {len(response.candidates) if response.candidates else 0}")
+            variant_telemetry = dict(telemetry, gemini_ms=round(seconds * 1000), **gen.usage_tokens(response))
+
+            # Extract result image (raw bytes, decoded only if it needs transcoding)
+            result_data = None
+            result_mime = None
+            for part in response.parts or []:
+                if part.inline_data is not None:
+                    result_data = part.inline_data.data
+                    result_mime = part.inline_data.mime_type
+                elif part.text is not None:
+                    result_text = part.text
+            if result_data is not None:
+                results.append((result_data, result_mime, variant_telemetry))
+                continue
+            reason = gen.blocked_reason(response)
+            block_reason = block_reason or reason
+            failures.append(("blocked" if reason else "no_image", variant_telemetry))
+
+        if results:
+            # An image has been paid for; from here the job only settles and delivers
+            job["settling"] = True
+            progress.reply_markup = None
+
+        duration_ms = round((time.perf_counter() - started) * 1000)
+        for failure, variant_telemetry in failures:
+            db.record_generation(
+                user_id, effect_id, status="failed", model=model,
+                duration_ms=duration_ms, failure_class=failure, **variant_telemetry,
+            )
+            await track_effect_health(bot, effect_id, "failed", failure)
+        settled = len(failures)
+
+        if not results:
+            await progress.stop()
+            # Release the whole hold and close the job
+            db.release_hold(
+                job["hold_id"], job["id"], f"blocked: {block_reason}" if block_reason else "no image in response"
+            )
+            new_balance = db.get_balance(user_id)
+            if block_reason:
+                msg = (
+                    "🚫 Нейросеть отказалась обрабатывать это фото\n\n"
+                    f"Кредит возвращён на баланс.\n⚡ Доступно зарядов: {new_balance}\n\n"
+                    "Попробуй другое фото или другой эффект."
+                )
+            else:
+                msg = f"❌ Что-то пошло не так\n\nКредит возвращён на баланс.\n⚡ Доступно зарядов: {new_balance}"
+                if result_text:
+                    msg += f"\n\nОтвет модели: {result_text[:200]}"
+            await bot.edit_message_text(
+                msg, chat_id=chat_id, message_id=job["status_message_id"], reply_markup=result_keyboard
             )
-            return BROWSING
+            return
 
-        db.record_generation(user.id, effect_id)
-        db.update_last_active(user.id)
-        referrer_id = db.credit_referral_on_generation(user.id)
+        # Balance once the hold is committed: failed variants are released, not charged
+        remaining = db.get_balance(user_id) + len(failures)
+
+        progress.stage = "send"
+        photos = []  # (bytes to upload, filename)
+        for result_data, result_mime, _ in results:
+            with metrics.timer("encode", effect_id) as encode:
+                photo_data, photo_filename = await asyncio.to_thread(
+                    images.prepare_output, result_data, result_mime, OUTPUT_FORMAT, OUTPUT_QUALITY
+                )
+            logger.info(
+                f"Result photo: {len(result_data)} bytes ({result_mime}) → uploading {len(photo_data)} bytes "
+                f"as {photo_filename}, encode {encode.seconds * 1000:.0f} ms"
+            )
+            photos.append((photo_data, photo_filename))
+
+        caption = f"✅ {effect['label']}\n⚡ Осталось зарядов: {remaining}"
+        if failures:
+            caption += f"\n\n↩️ Не удалось вариантов: {len(failures)} — заряды за них не списаны"
+
+        await progress.stop()
+        with metrics.timer("upload", effect_id):
+            if len(photos) == 1:
+                photo_data, photo_filename = photos[0]
+                await bot.send_photo(
+                    chat_id=chat_id,
+                    photo=photo_data,
+                    filename=photo_filename,
+                    caption=caption,
+                    reply_markup=result_keyboard,
+                )
+            else:
+                await bot.send_media_group(
+                    chat_id=chat_id,
+                    media=[
+                        InputMediaPhoto(media=photo_data, filename=photo_filename)
+                        for photo_data, photo_filename in photos
+                    ],
+                )
+        # The user has the images: charge delivered variants (the rest of the hold is released with
+        # the same write) and close the job before anything else can fail or a restart can requeue it
+        db.commit_hold(job["hold_id"], len(results), job["id"])
+        delivered = True
+        # Status message only goes once the result is there: a failed upload still reports into it
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=job["status_message_id"])
+        except Exception:
+            pass
+        if len(photos) > 1:
+            # Media groups can't carry buttons, so they follow in a separate message
+            try:
+                await bot.send_message(chat_id=chat_id, text=caption, reply_markup=result_keyboard)
+            except Exception as e:
+                logger.warning(f"Job {job['id']}: result caption not sent: {e}")
+
+        db.update_last_active(user_id)
+
+        # Credit referrer on first generation (only for referrer's first 10 referrals)
+        referrer_id = db.credit_referral_on_generation(user_id)
         if referrer_id:
             db.add_credits(referrer_id, 3)
-            logger.info(f"Credited referrer {referrer_id} with 3 credits (generation) for user {user.id}")
+            logger.info(f"Credited referrer {referrer_id} with 3 credits (generation) for user {user_id}")
 
-        db_user = db.get_user(user.id)
-        remaining = db_user["credits"] if db_user else 0
+        # N2: Credits Running Low
         if remaining == 1:
-            await notif.send_credits_low_warning(user.id)
-
-        output_buffer = io.BytesIO()
-        result_image.save(output_buffer, format="PNG")
-        output_buffer.seek(0)
-
-        result_keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔄 Попробовать снова", callback_data=f"effect_{effect_id}")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="browse_root")],
-        ])
+            await notif.send_credits_low_warning(user_id)
+
+        metrics.record("total", time.perf_counter() - started, effect_id)
+        sched.observe(effect_id, time.perf_counter() - started)
+        # Record generations for statistics (one row per delivered variant)
+        duration_ms = round((time.perf_counter() - started) * 1000)
+        for (_, _, variant_telemetry), (photo_data, _) in zip(results, photos):
+            db.record_generation(
+                user_id, effect_id, model=model,
+                duration_ms=duration_ms, output_bytes=len(photo_data), **variant_telemetry,
+            )
+            await track_effect_health(bot, effect_id, "success")
 
-        await status_msg.delete()
-        await update.message.reply_photo(
-            photo=output_buffer,
-            caption=f"✅ {effect['label']}\n⚡ Осталось зарядов: {remaining}",
-            reply_markup=result_keyboard,
-        )
+        # The user's handlers run meanwhile: change their UI state under the same per-user lock
+        anchor_message_id = job.get("anchor_message_id")
+        async with application.update_processor.user_lock(user_id):
+            user_data = application.user_data[user_id]
+            user_data["current_category"] = previous_category
+            if anchor_message_id and user_data.get("create_ui_message_id") == anchor_message_id:
+                user_data.pop("create_ui_message_id", None)
+                user_data.pop("create_ui_is_photo", None)
 
         # Delete old anchor (replaced by result photo buttons)
-        old_anchor_id = context.user_data.pop("create_ui_message_id", None)
-        context.user_data.pop("create_ui_is_photo", None)
-        if old_anchor_id:
+        if anchor_message_id:
             try:
-                await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=old_anchor_id)
+                await bot.delete_message(chat_id=chat_id, message_id=anchor_message_id)
             except Exception:
                 pass
 
+    except asyncio.CancelledError:
+        await progress.stop()
+        if job.get("cancelled") and not delivered:
+            await finish_cancelled_job(bot, job)
+        raise
+
     except Exception as e:
-        logger.error("Error during free_prompt generation: %s", e, exc_info=True)
-        db.record_generation(user.id, effect_id, status="failed")
-        new_balance = db.refund_credit(user.id)
-        previous_category = context.user_data.get("previous_category")
-        back_callback = f"cat_{previous_category}" if previous_category else "browse_root"
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔄 Попробовать снова", callback_data=f"effect_{effect_id}")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data=back_callback)],
-        ])
-        await status_msg.edit_text(
-            f"❌ Что-то пошло не так\n\nКредит возвращён.\n⚡ Доступно зарядов: {new_balance}\n\nОшибка: {str(e)[:100]}",
-            reply_markup=keyboard,
-        )
-        return BROWSING
+        await progress.stop()
+        if delivered:
+            # Already charged and closed; only the bookkeeping after delivery failed
+            logger.error(f"Job {job['id']} delivered, but finishing it failed: {e}", exc_info=True)
+            return
+        if gen.is_transient_error(e) and job["attempts"] < GENERATION_MAX_ATTEMPTS:
+            # Keep the credit and the job; try again once Gemini recovers
+            delay = GENERATION_RETRY_DELAY * 2 ** (job["attempts"] - 1)
+            logger.warning(f"Transient error on job {job['id']} (attempt {job['attempts']}), retry in {delay}s: {e}")
+            db.retry_job(job["id"], delay, str(e))
+            sched.submit_later(job, delay)
+            retrying = True
+            try:
+                await bot.edit_message_text(
+                    f"⏳ Нейросеть сейчас перегружена — повторю попытку через ~{delay} с.\n"
+                    "Если не получится, заряд вернётся на баланс.",
+                    chat_id=chat_id,
+                    message_id=job["status_message_id"],
+                    reply_markup=cancel_keyboard(job["id"]),
+                )
+            except Exception:
+                pass
+            return
+
+        logger.error("Error during transformation: %s", e, exc_info=True)
+        # Close the job and release its credit hold, then record the failed generation
+        db.release_hold(job["hold_id"], job["id"], str(e))
+        for _ in range(variants - settled):
+            db.record_generation(
+                user_id, effect_id, status="failed", model=model,
+                duration_ms=round((time.perf_counter() - started) * 1000),
+                failure_class=gen.failure_class(e),
+                **telemetry,
+            )
+        new_balance = db.get_balance(user_id)
+        text = f"{generation_error_text(e)}\n\nКредит возвращён на баланс.\n⚡ Доступно зарядов: {new_balance}"
+        try:
+            await bot.edit_message_text(
+                text, chat_id=chat_id, message_id=job["status_message_id"], reply_markup=result_keyboard
+            )
+        except Exception:
+            # Status message is gone or can't be edited: tell the user in a new one
+            await bot.send_message(chat_id=chat_id, text=text, reply_markup=result_keyboard)
     finally:
-        context.user_data.pop("effect_id", None)
-        context.user_data.pop("lucky_photo", None)
+        await progress.stop()
+        if not retrying:
+            release_submission(job.get("submission"))
 
-    return BROWSING
 
+async def finish_cancelled_job(bot, job: dict) -> None:
+    """Close a job the user cancelled: release its hold and claim, and say so in its status message."""
+    db.release_hold(job["hold_id"], job["id"], "cancelled by user", state="cancelled")
+    release_submission(job.get("submission"))
+    logger.info(f"Job {job['id']} cancelled by user {job['user_id']}")
+    new_balance = db.get_balance(job["user_id"])
+    try:
+        await bot.edit_message_text(
+            f"✖️ Генерация отменена\n\nКредит возвращён на баланс.\n⚡ Доступно зарядов: {new_balance}",
+            chat_id=job["chat_id"],
+            message_id=job["status_message_id"],
+            reply_markup=result_keyboard_for(job),
+        )
+    except Exception as e:
+        logger.warning(f"Could not update status message of cancelled job {job['id']}: {e}")
 
-async def lucky_prompt_expected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Handle non-text message when prompt text is expected."""
-    previous_category = context.user_data.get("previous_category")
-    back_callback = f"cat_{previous_category}" if previous_category else "browse_root"
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("⬅️ Назад", callback_data=back_callback)],
-    ])
-    await render_create_screen(
-        context,
-        update.effective_chat.id,
-        "Мне нужен текст, а не это 😄 Напиши словами что сделать с фото",
-        keyboard,
-    )
-    return WAITING_LUCKY_PROMPT
+
+async def cancel_generation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Cancel button under a generation's status message (works from any conversation state)."""
+    query = update.callback_query
+    job_id = int(query.data.removeprefix("cancel_job_"))
+    job = sched.find(job_id)
+
+    if job is None or job["user_id"] != query.from_user.id:
+        await query.answer("Эту генерацию уже не отменить")
+        return
+    if job.get("settling"):
+        await query.answer("Результат уже готов — отправляю")
+        return
+
+    cancelled = sched.cancel(job_id)
+    if cancelled is None:
+        await query.answer("Эту генерацию уже не отменить")
+        return
+    await query.answer("Генерация отменена")
+    if cancelled == "queued":
+        await finish_cancelled_job(context.bot, job)
+    # A running job is closed by run_generation_job as its task unwinds
 
 
 # ── Store Flow ───────────────────────────────────────────────────────────────
@@ -1276,8 +1934,7 @@ async def cancel_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def show_main_menu_fresh(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Send a fresh main menu message (not edit)."""
     user = update.effective_user
-    db_user = db.get_user(user.id)
-    credits = db_user["credits"] if db_user else 0
+    credits = db.get_balance(user.id)
     name = user.first_name or "друг"
     text = f"Привет, {name}!\n⚡ Доступно зарядов: {credits}\nВыбери действие 👇"
     await send_main_menu(context.bot, user.id, text, main_menu_keyboard())
@@ -1297,8 +1954,7 @@ async def recover_stale_callback(update: Update, context: ContextTypes.DEFAULT_T
     await query.answer("Бот обновился, открываю меню...")
 
     user = update.effective_user
-    db_user = db.get_user(user.id)
-    credits = db_user["credits"] if db_user else 0
+    credits = db.get_balance(user.id)
     name = user.first_name or "друг"
     text = f"Привет, {name}!\n⚡ Доступно зарядов: {credits}\nВыбери действие 👇"
 
@@ -1384,8 +2040,7 @@ async def handle_promo_code(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     if success:
         db.update_last_active(user.id)
-        db_user = db.get_user(user.id)
-        new_balance = db_user["credits"] if db_user else 0
+        new_balance = db.get_balance(user.id)
         await update.message.reply_text(
             f"✅ Промокод активирован!\n+{credits} зарядов добавлено\n\n⚡ Доступно зарядов: {new_balance}",
             reply_markup=back_to_main_keyboard(),
@@ -1453,7 +2108,7 @@ async def show_about(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def show_about_from_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Show about/disclaimer info (from reply keyboard text)."""
-    context.user_data.pop("lucky_photo", None)
+    drop_lucky_photo(context.user_data)
     text = (
         "ℹ️ О проекте\n\n"
         "Проект предназначен для людей достигших возраста 18+ "
@@ -1481,7 +2136,7 @@ async def show_about_from_text(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle /admin command."""
-    context.user_data.pop("lucky_photo", None)
+    drop_lucky_photo(context.user_data)
     user = update.effective_user
 
     logger.info(f"Admin attempt: user.id={user.id}, ADMIN_ID={ADMIN_ID}")
@@ -1493,7 +2148,11 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     await update.message.reply_text(
         "🔐 Админ-панель",
         reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
+            [
+                InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
+                InlineKeyboardButton("⏱ Тайминги", callback_data="admin_timings"),
+            ],
+            [InlineKeyboardButton("⚙️ Gemini", callback_data="admin_gemini")],
             [InlineKeyboardButton("📈 Weekly Report", callback_data="admin_report")],
             [InlineKeyboardButton("🗂 Raw Data", callback_data="admin_effects_report")],
             [InlineKeyboardButton("🎁 Подарочный промокод", callback_data="admin_promo")],
@@ -1553,6 +2212,127 @@ async def show_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     return ADMIN_STATS
 
 
+STAGE_LABELS = {
+    "queue": "Очередь",
+    "download": "Скачивание фото",
+    "preprocess": "Подготовка фото",
+    "gemini": "Gemini",
+    "encode": "Кодирование",
+    "upload": "Отправка",
+    "total": "Всего",
+}
+
+
+async def show_admin_timings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Show p50/p95/p99 per generation stage and per effect (recent in-memory window)."""
+    query = update.callback_query
+    await query.answer()
+
+    stage_lines = []
+    for stage in metrics.STAGES:
+        stats = metrics.summary(stage)
+        if stats:
+            stage_lines.append(
+                f"{STAGE_LABELS[stage]}: {stats['p50']:.2f} / {stats['p95']:.2f} / {stats['p99']:.2f} (n={stats['count']})"
+            )
+
+    effect_rows = []
+    for effect_id in metrics.effects():
+        total = metrics.summary("total", effect_id)
+        gemini = metrics.summary("gemini", effect_id)
+        if total:
+            label = TRANSFORMATIONS.get(effect_id, {}).get("label", effect_id)
+            gemini_p95 = f", Gemini p95 {gemini['p95']:.2f}" if gemini else ""
+            line = (
+                f"{label}: {total['p50']:.2f} / {total['p95']:.2f}{gemini_p95}, "
+                f"EWMA {sched.job_seconds(effect_id):.1f} (n={total['count']})"
+            )
+            effect_rows.append((total["count"], line))
+    effect_lines = [line for _, line in sorted(effect_rows, reverse=True)[:15]]
+
+    text = (
+        f"⏱ Тайминги генерации (последние {metrics.WINDOW} на этап)\n\n"
+        f"── По этапам, с (p50 / p95 / p99) ──\n"
+        + ("\n".join(stage_lines) or "Пока нет данных")
+        + "\n\n── По эффектам, всего с (p50 / p95) ──\n"
+        + ("\n".join(effect_lines) or "Пока нет данных")
+    )
+
+    await edit_message(
+        query,
+        text,
+        InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔄 Обновить", callback_data="admin_timings")],
+            [InlineKeyboardButton("⬅️ Назад", callback_data="admin_back")],
+        ]),
+    )
+    return ADMIN_STATS
+
+
+async def show_admin_gemini(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Show Gemini concurrency limit, its recent changes and queue state."""
+    query = update.callback_query
+    await query.answer()
+
+    limiter = gen.limiter()
+    baseline = limiter.baseline_latency
+    history_lines = [
+        f"{datetime.fromtimestamp(ts).strftime('%d.%m %H:%M:%S')}  {limit}  ({reason})"
+        for ts, limit, reason in list(limiter.history)[-15:]
+    ]
+
+    now = time.monotonic()
+    key_lines = []
+    for key in gen.api_keys():
+        key.refill(now)
+        quota = "без лимита" if key.unlimited else f"{key.tokens:.1f}/{key.capacity:.0f} запросов"
+        line = f"{key.name}: {quota}, в работе {key.in_flight}"
+        if key.quarantined_until > now:
+            line += f", карантин {key.quarantined_until - now:.0f} с"
+        key_lines.append(line)
+
+    router = gen.router()
+    model_lines = []
+    for model in dict.fromkeys([GEMINI_MODEL, *GEMINI_FALLBACK_MODELS, *router.models()]):
+        stats = router.stats(model)
+        p95 = f"{stats['p95']:.1f} с" if stats["p95"] is not None else "—"
+        status = "✅" if router.healthy(model) else "⚠️"
+        model_lines.append(f"{status} {model}: p95 {p95}, ошибки {stats['error_rate']:.0%} (n={stats['count']})")
+
+    effect_lines = []
+    for effect_id, wait in health.disabled().items():
+        failed, total = health.failure_rate(effect_id)
+        label = TRANSFORMATIONS.get(effect_id, {}).get("label", effect_id)
+        probe = f"проба через {wait / 60:.0f} мин" if wait > 0 else "ждёт пробы"
+        effect_lines.append(f"🚫 {label}: {failed}/{total} без результата, {probe}")
+
+    text = (
+        f"⚙️ Gemini\n\n"
+        f"Лимит параллельных запросов: {limiter.limit} ({limiter.min_limit}–{limiter.max_limit})\n"
+        f"В работе: {limiter.in_flight}, ждут слота: {limiter.waiting}\n"
+        f"Базовая задержка: {f'{baseline:.1f} с' if baseline is not None else '—'}\n"
+        f"Circuit breaker: {gen.circuit_state()}\n"
+        f"Очередь генераций: {sched.queue_depth()}, выполняется: {sched.active_count()}\n"
+        f"Ожидание нового заказа: {eta_text(sched.eta({'user_id': None, 'effect_id': None}))}"
+        f" (отказ при > {f'{MAX_QUEUE_ETA / 60:.0f} мин' if MAX_QUEUE_ETA else '∞'})\n\n"
+        "── Ключи API ──\n" + "\n".join(key_lines) + "\n\n"
+        f"── Модели (SLO: p95 ≤ {router.p95_threshold:.0f} с, ошибки ≤ {router.max_error_rate:.0%}) ──\n"
+        + "\n".join(model_lines) + "\n\n"
+        "── Отключённые эффекты ──\n" + ("\n".join(effect_lines) or "нет") + "\n\n"
+        "── История лимита ──\n" + "\n".join(reversed(history_lines))
+    )
+
+    await edit_message(
+        query,
+        text,
+        InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔄 Обновить", callback_data="admin_gemini")],
+            [InlineKeyboardButton("⬅️ Назад", callback_data="admin_back")],
+        ]),
+    )
+    return ADMIN_STATS
+
+
 async def show_admin_promo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Show promo code creation menu."""
     query = update.callback_query
@@ -1690,7 +2470,11 @@ async def admin_back(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await query.edit_message_text(
         "🔐 Админ-панель",
         reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
+            [
+                InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
+                InlineKeyboardButton("⏱ Тайминги", callback_data="admin_timings"),
+            ],
+            [InlineKeyboardButton("⚙️ Gemini", callback_data="admin_gemini")],
             [InlineKeyboardButton("📈 Weekly Report", callback_data="admin_report")],
             [InlineKeyboardButton("🗂 Raw Data", callback_data="admin_effects_report")],
             [InlineKeyboardButton("🎁 Подарочный промокод", callback_data="admin_promo")],
@@ -1743,7 +2527,11 @@ async def handle_admin_source_name(update: Update, context: ContextTypes.DEFAULT
     await update.message.reply_text(
         "🔐 Админ-панель",
         reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
+            [
+                InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
+                InlineKeyboardButton("⏱ Тайминги", callback_data="admin_timings"),
+            ],
+            [InlineKeyboardButton("⚙️ Gemini", callback_data="admin_gemini")],
             [InlineKeyboardButton("📈 Weekly Report", callback_data="admin_report")],
             [InlineKeyboardButton("🗂 Raw Data", callback_data="admin_effects_report")],
             [InlineKeyboardButton("🎁 Подарочный промокод", callback_data="admin_promo")],
@@ -1958,8 +2746,6 @@ async def show_admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def handle_admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """N5: Send new effects broadcast to active users."""
-    import asyncio
-
     effects_list = update.message.text.strip()
 
     # Get active users
@@ -1972,29 +2758,128 @@ async def handle_admin_broadcast(update: Update, context: ContextTypes.DEFAULT_T
     conn.close()
 
     await update.message.reply_text(f"⏳ Отправляю {len(users)} пользователям...")
+    # Sent in the background as bulk traffic, so the bot keeps answering everyone meanwhile
+    start_background(
+        run_broadcast(context.bot, update.effective_chat.id, [u["telegram_id"] for u in users], effects_list),
+        name="broadcast",
+    )
+    return ADMIN_MENU
+
 
+async def run_broadcast(bot, admin_chat_id: int, user_ids: list[int], effects_list: str) -> None:
+    """N5 send loop; pacing is left to the bot's rate limiter (notifications are bulk priority)."""
     sent_count = 0
-    for u in users:
-        success = await notif.send_new_effects(u["telegram_id"], effects_list)
-        if success:
+    for user_id in user_ids:
+        if await notif.send_new_effects(user_id, effects_list):
             sent_count += 1
-        await asyncio.sleep(0.1)  # Rate limit
 
-    await update.message.reply_text(
-        f"✅ Рассылка завершена!\nОтправлено: {sent_count}/{len(users)}",
+    await bot.send_message(
+        chat_id=admin_chat_id,
+        text=f"✅ Рассылка завершена!\nОтправлено: {sent_count}/{len(user_ids)}",
         reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("⬅️ Админ-панель", callback_data="admin_back")],
         ]),
     )
-    return ADMIN_MENU
 
 
 # ── Main ─────────────────────────────────────────────────────────────────────
 
 
+async def sweep_credit_holds() -> None:
+    """Release expired credit holds that no live job claims, every HOLD_SWEEP_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(HOLD_SWEEP_INTERVAL)
+        try:
+            _, released = db.sweep_holds()
+            if released:
+                logger.warning(f"Released {released} expired credit hold(s)")
+        except Exception as e:
+            logger.error(f"Credit hold sweep failed: {e}")
+
+
+async def prepare_assets(bot) -> None:
+    """Build image derivatives and collages off the event loop, then warm up assets if configured."""
+    try:
+        count = await asyncio.to_thread(build_asset_derivatives)
+        logger.info(f"Image derivatives ready: {count}")
+    except Exception as e:
+        logger.error(f"Building image derivatives failed, sending originals: {e}", exc_info=True)
+    try:
+        built = await asyncio.to_thread(build_category_collages)
+        ready = sum(1 for cat in CATEGORIES.values() if cat.get("collage_image"))
+        logger.info(f"Category collages ready: {ready} ({built} rebuilt)")
+    except Exception as e:
+        logger.error(f"Building category collages failed: {e}", exc_info=True)
+    if ASSET_WARMUP_CHAT_ID:
+        await assets.warm_up(bot, ASSET_WARMUP_CHAT_ID, asset_paths())
+
+
+def is_ready(application: Application) -> bool:
+    """Readiness: polling is running, generation workers are alive and the database answers."""
+    conn = db.get_connection()
+    try:
+        conn.execute("SELECT 1")
+    finally:
+        conn.close()
+    return application.running and sched.is_running()
+
+
+async def post_init(application: Application) -> None:
+    """Start background workers once the event loop is running."""
+    disabled = health.init(
+        EFFECT_HEALTH_FAILURE_RATE,
+        EFFECT_HEALTH_MIN_SAMPLES,
+        EFFECT_HEALTH_COOLDOWN,
+        history=[
+            tuple(row) for row in db.get_recent_generations()
+            if TRANSFORMATIONS.get(row["effect_id"], {}).get("type") != "free_prompt"
+        ],
+    )
+    if disabled:
+        logger.warning(f"Effects disabled by recent failures: {', '.join(disabled)}")
+
+    assets.init(BASE_DIR)
+    start_background(prepare_assets(application.bot), name="asset-prep")
+
+    interrupted = db.requeue_interrupted_jobs()
+    sched.start(
+        partial(run_generation_job, application),
+        workers=GENERATION_WORKERS,
+        on_position=partial(on_generation_position, application),
+    )
+
+    # Give pre-hold jobs a hold and release holds left by a crash, before resuming jobs
+    adopted, released = db.sweep_holds()
+    if adopted or released:
+        logger.info(f"Credit holds reconciled: {adopted} job(s) moved to holds, {released} expired hold(s) released")
+    start_background(sweep_credit_holds(), name="credit-hold-sweeper")
+
+    # Resume jobs that were queued (or interrupted mid-generation) before a restart
+    jobs = db.get_queued_jobs()
+    for row in jobs:
+        job = dict(row)
+        sched.submit_later(job, job.pop("delay_seconds"))
+    if jobs:
+        logger.info(f"Resumed {len(jobs)} generation jobs ({interrupted} interrupted by restart)")
+
+    await monitoring.start(METRICS_PORT, ready=partial(is_ready, application))
+
+
 def main() -> None:
     """Start the bot."""
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    rate_limiter = ratelimit.TelegramRateLimiter(TELEGRAM_OVERALL_RATE, TELEGRAM_CHAT_RATE)
+    metrics.gauge("photobot_telegram_rate_limited", lambda: rate_limiter.waiting)
+    update_processor = monitoring.InstrumentedUpdateProcessor(UPDATE_CONCURRENCY)
+    metrics.gauge("photobot_updates_in_progress", lambda: update_processor.active)
+    metrics.gauge("photobot_updates_waiting", lambda: update_processor.waiting)
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(update_processor)
+        .rate_limiter(rate_limiter)
+        .post_init(post_init)
+        .build()
+    )
 
     # Initialize notification system
     notif.init_notifications(app.bot)
@@ -2058,6 +2943,7 @@ def main() -> None:
                 CallbackQueryHandler(back_to_browse, pattern="^back_to_browse$"),
                 CallbackQueryHandler(show_browse_root, pattern="^browse_root$"),
                 CallbackQueryHandler(browse_category, pattern="^cat_"),
+                CallbackQueryHandler(select_variants, pattern="^variants_"),
                 CallbackQueryHandler(show_main_menu, pattern="^back_to_main$"),
             ] + reply_kb + [
                 MessageHandler(~filters.PHOTO & ~filters.COMMAND, photo_expected),
@@ -2083,6 +2969,7 @@ def main() -> None:
             WAITING_LUCKY_PROMPT: reply_kb + [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_lucky_prompt),
                 MessageHandler(~filters.TEXT & ~filters.COMMAND, lucky_prompt_expected),
+                CallbackQueryHandler(select_lucky_variants, pattern="^variants_"),
                 CallbackQueryHandler(restart_bot, pattern="^restart$"),
                 CallbackQueryHandler(back_to_browse, pattern="^back_to_browse$"),
                 CallbackQueryHandler(show_browse_root, pattern="^browse_root$"),
@@ -2101,6 +2988,8 @@ def main() -> None:
             ADMIN_MENU: [
                 CallbackQueryHandler(restart_bot, pattern="^restart$"),
                 CallbackQueryHandler(show_admin_stats, pattern="^admin_stats$"),
+                CallbackQueryHandler(show_admin_gemini, pattern="^admin_gemini$"),
+                CallbackQueryHandler(show_admin_timings, pattern="^admin_timings$"),
                 CallbackQueryHandler(show_admin_report, pattern="^admin_report$"),
                 CallbackQueryHandler(show_admin_effects_report, pattern="^admin_effects_report$"),
                 CallbackQueryHandler(show_admin_effects_report_xlsx, pattern="^admin_effects_report_xlsx$"),
@@ -2115,6 +3004,8 @@ def main() -> None:
             ],
             ADMIN_STATS: [
                 CallbackQueryHandler(restart_bot, pattern="^restart$"),
+                CallbackQueryHandler(show_admin_gemini, pattern="^admin_gemini$"),
+                CallbackQueryHandler(show_admin_timings, pattern="^admin_timings$"),
                 CallbackQueryHandler(admin_back, pattern="^admin_back$"),
             ],
             ADMIN_REPORT: [
@@ -2153,6 +3044,8 @@ def main() -> None:
         ],
     )
 
+    # Cancel works from any state, so it sits in front of the conversation
+    app.add_handler(CallbackQueryHandler(cancel_generation, pattern=r"^cancel_job_\d+$"))
     app.add_handler(conv_handler)
     # Fallback recovery for stale/unknown callback_data after deploys.
     app.add_handler(CallbackQueryHandler(recover_stale_callback))
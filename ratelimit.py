@@ -0,0 +1,162 @@
+"""
+Outbound Telegram rate limiter for Photo Bot.
+Every Bot API call that targets a chat goes through one limiter: a global
+messages-per-second cap shared by all send paths, per-chat caps (private
+chats and groups differ), interactive replies served before bulk sends
+(notifications, broadcasts), and RetryAfter honoured by pausing all sends.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Callable, Coroutine
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Bot API limits (https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this)
+DEFAULT_OVERALL_RATE = 30.0    # messages per second across all chats
+DEFAULT_CHAT_RATE = 1.0        # messages per second in one private chat (short bursts are fine)
+DEFAULT_GROUP_RATE = 20 / 60   # messages per second in one group
+CHAT_BURST = 3                 # messages a chat may get back to back before its rate applies
+MAX_RETRIES = 2                # retries after a RetryAfter before the error is raised
+
+INTERACTIVE = 0
+BULK = 1
+# Pass as rate_limit_args to mark a send as bulk (served after every waiting interactive one)
+BULK_ARGS = {"priority": BULK}
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations: reserve() returns how long to wait for the token."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        self.refill(time.monotonic())
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    @property
+    def idle(self) -> bool:
+        self.refill(time.monotonic())
+        return self.tokens >= self.burst
+
+
+class TelegramRateLimiter(BaseRateLimiter[dict]):
+    """Bot API rate limiter with interactive-over-bulk priority.
+
+    Requests without a chat_id (getUpdates, answerCallbackQuery, getFile, ...)
+    are not limited. rate_limit_args may be {"priority": BULK} and/or
+    {"max_retries": n}.
+    """
+
+    def __init__(
+        self,
+        overall_rate: float = DEFAULT_OVERALL_RATE,
+        chat_rate: float = DEFAULT_CHAT_RATE,
+        group_rate: float = DEFAULT_GROUP_RATE,
+        max_retries: int = MAX_RETRIES,
+    ):
+        self._overall = TokenBucket(overall_rate, overall_rate)
+        self._chat_rate = chat_rate
+        self._group_rate = group_rate
+        self._max_retries = max_retries
+        self._chats: dict[int | str, TokenBucket] = {}
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []  # (priority, seq, future) heap
+        self._seq = itertools.count()
+        self._dispatcher: asyncio.Task | None = None
+        self._paused_until = 0.0  # monotonic time a RetryAfter lifts
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    @property
+    def waiting(self) -> int:
+        """Requests waiting for a global slot."""
+        return sum(1 for _, _, waiter in self._waiters if not waiter.done())
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, bool | dict[str, Any] | None]],
+        args: Any,
+        kwargs: dict[str, Any],
+        endpoint: str,
+        data: dict[str, Any],
+        rate_limit_args: dict | None,
+    ) -> bool | dict[str, Any] | None:
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+
+        priority = (rate_limit_args or {}).get("priority", INTERACTIVE)
+        max_retries = (rate_limit_args or {}).get("max_retries", self._max_retries)
+        attempt = 0
+        while True:
+            await self._acquire(chat_id, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = float(e.retry_after)
+                metrics.inc("photobot_telegram_retry_after_total", endpoint=endpoint)
+                # Flood control applies to the whole bot: hold every send until it lifts
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                if attempt >= max_retries:
+                    raise
+                attempt += 1
+                logger.warning(f"Telegram flood control on {endpoint}: retry {attempt} in {retry_after:.0f}s")
+
+    async def _acquire(self, chat_id: int | str, priority: int) -> None:
+        """Wait for a slot in the chat, then for a global slot (by priority)."""
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10_000:
+                self._chats = {chat: b for chat, b in self._chats.items() if not b.idle}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self._group_rate if is_group else self._chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, CHAT_BURST)
+        delay = bucket.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), waiter))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch(), name="telegram-rate-limiter")
+        await waiter
+
+    async def _dispatch(self) -> None:
+        """Hand out global slots, highest priority first, as the overall bucket refills."""
+        while self._waiters:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            self._overall.refill(time.monotonic())
+            if self._overall.tokens < 1:
+                await asyncio.sleep((1 - self._overall.tokens) / self._overall.rate)
+                continue
+            _, _, waiter = heapq.heappop(self._waiters)
+            if waiter.done():
+                continue  # its request was cancelled while waiting
+            self._overall.tokens -= 1
+            waiter.set_result(None)
@@ -19,10 +19,13 @@ import sys
 
 import yaml
 
+import images
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 EFFECTS_YAML = os.path.join(BASE_DIR, "effects.yaml")
 PROMPTS_DIR = os.path.join(BASE_DIR, "prompts")
 IMAGES_DIR = os.path.join(BASE_DIR, "images")
+DERIVATIVE_DIR = os.path.join(BASE_DIR, images.DERIVATIVE_SUBDIR)
 
 TITLE_RE = re.compile(r"=+\s*IDEA\s+(\d+)\s*:\s*(.+?)\s*=+", re.IGNORECASE)
 MENU_DESC_RE = re.compile(r"Transformation description \(RU\):\s*(.+)")
@@ -393,6 +396,9 @@ def main():
             dst = os.path.join(IMAGES_DIR, f"{eid}.png")
             shutil.copy2(e["png_src"], dst)
             print(f"  Copied: images/{eid}.png")
+            # Delivery copy the bot sends instead of the full-size PNG
+            derivative = images.build_derivative(dst, DERIVATIVE_DIR)
+            print(f"  Built: {os.path.relpath(derivative, BASE_DIR)} ({os.path.getsize(derivative) // 1024} KB)")
 
         # Build YAML entry
         tips_escaped = e["tips"].replace('"', '\\"')
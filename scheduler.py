@@ -0,0 +1,241 @@
+"""
+Generation scheduler for Photo Bot.
+Bounded worker pool in front of Gemini: a global in-flight limit, at most one
+active job per user, queue-position updates while jobs wait their turn,
+cancellation of waiting or running jobs, and ETAs from per-effect EWMA run times.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_JOB_SECONDS = 30.0  # assumed run time until a job has been timed
+EWMA_ALPHA = 0.2            # weight of the newest run time in the moving average
+
+# Worker pool state (set on start)
+_runner: Callable[[dict], Awaitable[None]] | None = None
+_on_position: Callable[[dict, int], Awaitable[None]] | None = None
+_workers: list[asyncio.Task] = []
+_wakeup: asyncio.Event | None = None
+
+_pending: list[dict] = []      # jobs waiting for a worker, FIFO
+_active: dict[int, dict] = {}  # user_id → job currently running
+_running: dict[int, asyncio.Task] = {}  # job id → task running it
+_delayed: dict[int, tuple[dict, asyncio.TimerHandle]] = {}  # job id → (job, timer that will submit it)
+_notifying: set[asyncio.Task] = set()  # position updates in flight (referenced until done)
+_ewma: dict[str | None, float] = {}  # effect_id (None = all effects) → smoothed job run time, seconds
+
+
+def start(
+    runner: Callable[[dict], Awaitable[None]],
+    workers: int = DEFAULT_WORKERS,
+    on_position: Callable[[dict, int], Awaitable[None]] | None = None,
+) -> None:
+    """Start the worker pool. Must be called from inside the running event loop.
+
+    runner(job) does the actual work; on_position(job, position) is called
+    whenever a waiting job's queue position changes.
+    """
+    global _runner, _on_position, _wakeup
+    _runner = runner
+    _on_position = on_position
+    _wakeup = asyncio.Event()
+    for n in range(max(1, workers)):
+        _workers.append(asyncio.create_task(_worker(n), name=f"generation-worker-{n}"))
+    logger.info(f"Generation scheduler started ({len(_workers)} workers)")
+
+
+def submit(job: dict) -> int:
+    """Queue a job (must contain "user_id"). Returns its queue position, 0 = starts now.
+
+    Sets job["position"] and job["submitted_at"] (monotonic time, for queue-wait metrics).
+    """
+    if _wakeup is None:
+        raise RuntimeError("Generation scheduler not started")
+    job["submitted_at"] = time.monotonic()
+    _pending.append(job)
+    position = queue_position(job)
+    job["position"] = position
+    _wakeup.set()
+    return position
+
+
+def submit_later(job: dict, delay: float) -> None:
+    """Queue a job (must contain "id") after delay seconds, e.g. for a retry."""
+    if delay <= 0:
+        submit(job)
+        return
+
+    def _submit() -> None:
+        _delayed.pop(job["id"], None)
+        submit(job)
+
+    _delayed[job["id"]] = (job, asyncio.get_running_loop().call_later(delay, _submit))
+
+
+def find(job_id: int) -> dict | None:
+    """The waiting, delayed or running job with this id, if the scheduler holds it."""
+    for job in _pending:
+        if job.get("id") == job_id:
+            return job
+    if job_id in _delayed:
+        return _delayed[job_id][0]
+    return next((job for job in _active.values() if job.get("id") == job_id), None)
+
+
+def cancel(job_id: int) -> str | None:
+    """Cancel a waiting, delayed or running job, freeing its place at once.
+
+    Returns "queued" if the job was dropped before it started (the caller
+    cleans up), "running" if its task was cancelled (the runner sees
+    CancelledError with job["cancelled"] set), or None if the scheduler
+    does not hold the job.
+    """
+    for i, job in enumerate(_pending):
+        if job.get("id") == job_id:
+            del _pending[i]
+            job["cancelled"] = True
+            _publish_positions()
+            return "queued"
+    if job_id in _delayed:
+        job, timer = _delayed.pop(job_id)
+        timer.cancel()
+        job["cancelled"] = True
+        return "queued"
+    job = find(job_id)
+    task = _running.get(job_id)
+    if job is None or task is None or task.done():
+        return None
+    job["cancelled"] = True
+    task.cancel()
+    return "running"
+
+
+def queue_position(job: dict) -> int:
+    """Estimated number of jobs that will start before this one (0 = next to run)."""
+    ahead = next((i for i, pending in enumerate(_pending) if pending is job), None)
+    if ahead is None:
+        return 0
+    user_id = job["user_id"]
+    if user_id in _active or any(pending["user_id"] == user_id for pending in _pending[:ahead]):
+        return ahead + 1
+    free = len(_workers) - len(_active)
+    return max(0, ahead + 1 - free)
+
+
+def observe(effect_id: str | None, seconds: float) -> None:
+    """Feed one completed job's run time into the effect's and the overall moving average."""
+    for key in (effect_id, None):
+        previous = _ewma.get(key)
+        _ewma[key] = seconds if previous is None else (1 - EWMA_ALPHA) * previous + EWMA_ALPHA * seconds
+
+
+def job_seconds(effect_id: str | None = None) -> float:
+    """Expected run time of one job: the effect's average, else the overall one, else the default."""
+    return _ewma.get(effect_id) or _ewma.get(None) or DEFAULT_JOB_SECONDS
+
+
+def eta(job: dict) -> float:
+    """Seconds until a job finishes: the work ahead of it spread over the workers, plus its own run.
+
+    job needs "user_id" and "effect_id"; if it is not queued yet, it is
+    treated as joining the back of the queue (the estimate shown on submit).
+    Jobs of the same user run one at a time, so its own earlier jobs count in full.
+    """
+    now = time.monotonic()
+    index = next((i for i, pending in enumerate(_pending) if pending is job), len(_pending))
+    ahead = [(pending, job_seconds(pending.get("effect_id"))) for pending in _pending[:index]]
+    ahead += [(delayed, job_seconds(delayed.get("effect_id"))) for delayed, _ in _delayed.values()]
+    ahead += [
+        (active, max(0.0, job_seconds(active.get("effect_id")) - (now - active.get("started_at", now))))
+        for active in _active.values()
+    ]
+
+    wait = 0.0
+    if len(ahead) >= len(_workers):
+        wait = sum(seconds for _, seconds in ahead) / max(1, len(_workers))
+    own = sum(seconds for other, seconds in ahead if other["user_id"] == job["user_id"])
+    return max(wait, own) + job_seconds(job.get("effect_id"))
+
+
+def queue_depth() -> int:
+    """Number of jobs waiting for a worker (including delayed retries)."""
+    return len(_pending) + len(_delayed)
+
+
+def active_count() -> int:
+    """Number of jobs currently running."""
+    return len(_active)
+
+
+def is_running() -> bool:
+    """True once started and while every worker is alive."""
+    return bool(_workers) and not any(worker.done() for worker in _workers)
+
+
+metrics.gauge("photobot_generation_queue_depth", queue_depth)
+metrics.gauge("photobot_generation_active", active_count)
+metrics.gauge("photobot_generation_eta_seconds", lambda: eta({"user_id": None, "effect_id": None}))
+
+
+def _take_next() -> dict | None:
+    """Pop the oldest waiting job whose user has no job running."""
+    for i, job in enumerate(_pending):
+        if job["user_id"] not in _active:
+            del _pending[i]
+            _active[job["user_id"]] = job
+            return job
+    return None
+
+
+def _publish_positions() -> None:
+    """Notify waiting jobs whose queue position changed."""
+    if _on_position is None:
+        return
+    for job in list(_pending):
+        position = queue_position(job)
+        if position != job.get("position"):
+            job["position"] = position
+            task = asyncio.create_task(_safe_on_position(job, position))
+            _notifying.add(task)
+            task.add_done_callback(_notifying.discard)  # _safe_on_position logs its own failures
+
+
+async def _safe_on_position(job: dict, position: int) -> None:
+    try:
+        await _on_position(job, position)
+    except Exception as e:
+        logger.warning(f"Queue position update failed for user {job['user_id']}: {e}")
+
+
+async def _worker(n: int) -> None:
+    """Run jobs one at a time, forever."""
+    while True:
+        job = _take_next()
+        if job is None:
+            _wakeup.clear()
+            await _wakeup.wait()
+            continue
+
+        _publish_positions()
+        job["started_at"] = time.monotonic()
+        task = asyncio.create_task(_runner(job))
+        _running[job.get("id")] = task
+        try:
+            await task
+        except asyncio.CancelledError:
+            if not job.get("cancelled"):
+                raise  # the worker itself is being stopped
+        except Exception as e:
+            logger.error(f"Generation worker {n} job failed: {e}", exc_info=True)
+        finally:
+            _running.pop(job.get("id"), None)
+            _active.pop(job["user_id"], None)
+            _wakeup.set()
+            _publish_positions()
@@ -0,0 +1,65 @@
+"""Tests for result-image preparation (images.prepare_output)."""
+
+import io
+import sys
+from pathlib import Path
+
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import images
+
+LIMIT = 300_000  # stands in for Telegram's 10 MB so the inputs stay small
+
+
+def noise_png(size: tuple[int, int]) -> bytes:
+    """PNG of RGB noise: compresses badly in any format."""
+    image = Image.merge("RGB", [Image.effect_noise(size, 80) for _ in range(3)])
+    buf = io.BytesIO()
+    image.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def test_oversized_result_is_transcoded_under_the_limit(monkeypatch):
+    monkeypatch.setattr(images, "TELEGRAM_PHOTO_MAX_BYTES", LIMIT)
+    data = noise_png((1000, 1000))
+    assert len(data) > LIMIT
+
+    output, filename = images.prepare_output(data, "image/png")
+
+    assert len(output) <= LIMIT
+    assert filename == "result.jpg"
+    assert Image.open(io.BytesIO(output)).format == "JPEG"
+
+
+def test_oversized_png_is_downscaled_under_the_limit(monkeypatch):
+    monkeypatch.setattr(images, "TELEGRAM_PHOTO_MAX_BYTES", LIMIT)
+    data = noise_png((600, 600))
+    assert len(data) > LIMIT
+
+    output, filename = images.prepare_output(data, "image/png", output_format="png")
+
+    result = Image.open(io.BytesIO(output))
+    assert len(output) <= LIMIT
+    assert filename == "result.png"
+    assert result.format == "PNG"
+    assert result.width < 600 and result.width == result.height
+
+
+def test_result_within_limit_is_sent_unchanged():
+    data = noise_png((64, 64))
+
+    assert images.prepare_output(data, "image/png") == (data, "result.png")
+
+
+def test_result_over_telegram_dimensions_is_resized():
+    image = Image.new("RGB", (9000, 3000), "white")
+    buf = io.BytesIO()
+    image.save(buf, format="WEBP")
+
+    output, _ = images.prepare_output(buf.getvalue(), "image/webp")
+
+    result = Image.open(io.BytesIO(output))
+    assert result.width + result.height <= images.TELEGRAM_PHOTO_MAX_DIMENSIONS
+    assert abs(result.width / result.height - 3) < 0.01